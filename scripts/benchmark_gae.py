@@ -0,0 +1,17 @@
+"""
+Compares the sequential and associative scan GAE strategies over rollout shapes and shows which one strategy="auto"
+and the timing based strategy="benchmark" pick for each of them.
+
+python scripts/benchmark_gae.py
+"""
+from walle_rl.agents.ppo.gae import auto_gae_strategy, benchmark_gae, select_gae_strategy
+
+if __name__ == "__main__":
+    for T in [128, 1024, 10000]:
+        for n_envs in [1, 8, 64, 512]:
+            times = benchmark_gae(T, n_envs)
+            print(
+                f"T={T:6d} n_envs={n_envs:4d} | "
+                f"scan {times['scan'] * 1e3:8.3f} ms | associative {times['associative'] * 1e3:8.3f} ms | "
+                f"auto picks {auto_gae_strategy(T, n_envs)} | benchmark picks {select_gae_strategy(T, n_envs)}"
+            )
@@ -0,0 +1,104 @@
+"""
+Compares the python rollout loop (Rollout.collect) against the fully jitted rollout (Rollout.collect_jax) on the
+bundled pure-JAX environments. Runs on CPU only machines.
+
+python scripts/benchmark_jax_rollout.py
+"""
+import time
+
+import jax
+import numpy as np
+import optax
+
+import walle_rl.explore as explore
+from walle_rl.architecture.ac.core import ActorCritic
+from walle_rl.architecture.mlp import MLP
+from walle_rl.common.random import PRNGSequence
+from walle_rl.common.rollout import Rollout
+from walle_rl.common.utils import get_action_dim
+from walle_rl.envs import CartPole, JaxEnv, Pendulum
+
+
+class HostVecEnv:
+    """
+    Steps a JaxEnv one batch at a time from python and returns numpy arrays, mimicking a SB3 vectorized env
+    """
+
+    def __init__(self, env: JaxEnv, n_envs: int, seed: int = 0) -> None:
+        self.env = env
+        self.rng = PRNGSequence(seed)
+        self.n_envs = n_envs
+        self._step = jax.jit(env.vmap_step)
+
+    def reset(self):
+        self.state, obs = self.env.vmap_reset(next(self.rng), self.n_envs)
+        return np.array(obs)
+
+    def step(self, actions):
+        self.state, obs, rews, dones, infos = self._step(next(self.rng), self.state, actions)
+        terminal_obs = np.array(infos["terminal_observation"])
+        infos = [dict(terminal_observation=o) for o in terminal_obs]
+        return np.array(obs), np.array(rews), np.array(dones), infos
+
+
+def make_ac(rng, env, sample_obs):
+    act_dims = get_action_dim(env.action_space)
+    if isinstance(env, CartPole):
+        explorer = explore.Categorical()
+        act_dims = int(env.action_space.n)
+    else:
+        explorer = explore.Gaussian(act_dims=act_dims)
+    return ActorCritic(
+        rng=rng,
+        actor=MLP([64, 64, act_dims]),
+        critic=MLP([64, 64, 1]),
+        explorer=explorer,
+        sample_obs=sample_obs,
+        act_dims=act_dims,
+        actor_optim=optax.adam(learning_rate=1e-4),
+        critic_optim=optax.adam(learning_rate=4e-4),
+    )
+
+
+def bench(env: JaxEnv, n_envs: int, steps: int, repeats: int = 3):
+    rng = PRNGSequence(0)
+    _, obs = env.vmap_reset(next(rng), n_envs)
+    ac = make_ac(rng, env, obs)
+    rollout = Rollout()
+
+    host_env = HostVecEnv(env, n_envs)
+
+    def policy(o):
+        res = ac.step(key=next(rng), obs=o)
+        res["actions"] = np.array(res["actions"])
+        return res
+
+    def run_python():
+        rollout.collect(policy=policy, env=host_env, steps=steps, n_envs=n_envs, max_ep_len=env.max_episode_steps, verbose=0)
+
+    def run_jax():
+        res = rollout.collect_jax(
+            rng_key=next(rng), policy_params=ac.policy_params, policy=ac.policy_fn, env=env, steps=steps, n_envs=n_envs
+        )
+        jax.block_until_ready(res)
+
+    times = dict()
+    for name, fn in [("python", run_python), ("jax", run_jax)]:
+        fn()  # warmup / compile
+        stime = time.time_ns()
+        for _ in range(repeats):
+            fn()
+        times[name] = (time.time_ns() - stime) * 1e-9 / repeats
+    return times
+
+
+if __name__ == "__main__":
+    for env in [CartPole(), Pendulum()]:
+        for n_envs, steps in [(4, 500), (16, 500), (64, 500)]:
+            times = bench(env, n_envs, steps)
+            sps = {k: steps * n_envs / v for k, v in times.items()}
+            print(
+                f"{type(env).__name__:10s} n_envs={n_envs:3d} steps={steps} | "
+                f"python {sps['python']:10.0f} steps/s | jax {sps['jax']:10.0f} steps/s | "
+                f"speedup {times['python'] / times['jax']:6.1f}x"
+            )
@@ -0,0 +1,31 @@
+"""
+Streams demonstration trajectories to a sharded on-disk dataset and samples minibatches from it without loading the
+whole dataset into memory
+"""
+import numpy as np
+
+from walle_rl.common.rollout import Rollout
+from walle_rl.dataset import TrajectoryDataset, TrajectoryWriter
+from walle_rl.envs.vec_env import make_vec_env
+
+if __name__ == "__main__":
+    env_id = "CartPole-v1"
+    num_cpu = 4
+    seed = 0
+    env = make_vec_env(env_id, num_cpu, seed=seed)
+
+    # replace with an expert policy
+    def policy(obs):
+        return (obs[:, 2] + 0.5 * obs[:, 3] > 0).astype(int)
+
+    rollout = Rollout()
+    with TrajectoryWriter("workspace/demos/cartpole", shard_size=10_000, overwrite=True) as writer:
+        for traj in rollout.iter_trajectories(policy=policy, env=env, n_envs=num_cpu, n_trajectories=200, max_ep_len=500):
+            writer.write(traj)
+    env.close()
+
+    dataset = TrajectoryDataset("workspace/demos/cartpole", seed=seed)
+    print(f"{len(dataset)} episodes, {dataset.n_transitions} transitions, {len(dataset.shards)} shards")
+    batch = dataset.sample(256, keys=["observations", "actions"], next_keys=["observations"])
+    print({k: v.shape for k, v in batch.items()})
+    print("mean episode return", np.mean([traj["rewards"].sum() for traj in dataset]))
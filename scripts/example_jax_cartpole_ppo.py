@@ -0,0 +1,61 @@
+import time
+import numpy as np
+from walle_rl.agents.ppo.agent import PPO
+from walle_rl.agents.ppo.buffer import PPOBuffer
+from walle_rl.architecture.mlp import MLP
+
+import jax
+from walle_rl.common.random import PRNGSequence
+from walle_rl.architecture.ac.core import ActorCritic
+from walle_rl.envs import CartPole
+import optax
+
+import walle_rl.explore as explore
+from walle_rl.logger.logger import Logger
+# RNG sequence
+rng = PRNGSequence(0)
+np.random.seed(0)
+
+# pure-JAX env, the whole rollout of an epoch runs as a single XLA program
+env = CartPole(max_episode_steps=500)
+num_envs = 4
+_, obs = env.vmap_reset(next(rng), num_envs)
+act_dims = int(env.action_space.n)
+actor=MLP([64,64,act_dims], output_activation=None)
+critic=MLP([64,64,1], output_activation=None)
+ac = ActorCritic(
+    rng=rng,
+    actor=actor,
+    critic=critic,
+    explorer=explore.Categorical(),
+    sample_obs=obs,
+    act_dims=act_dims,
+    actor_optim=optax.adam(learning_rate=1e-4),
+    critic_optim=optax.adam(learning_rate=4e-4)
+)
+logger = Logger(tensorboard=False, wandb=False, cfg=dict(), workspace="workspace", exp_name="test")
+steps_per_epoch = 2000
+steps_per_epoch = steps_per_epoch // num_envs
+buffer = PPOBuffer(buffer_size=steps_per_epoch, observation_space=env.observation_space, action_space=env.action_space, n_envs=num_envs)
+algo = PPO(max_ep_len=500)
+def t_cb(epoch):
+    stats = logger.log(step=epoch)
+    logger.pretty_print_table(stats)
+    logger.reset()
+
+stime = time.time_ns()
+algo.train_loop(
+    rng=rng,
+    ac=ac,
+    env=env,
+    buffer=buffer,
+    steps_per_epoch=steps_per_epoch,
+    batch_size=512,
+    logger=logger,
+    update_iters=80,
+    n_epochs=50,
+    train_callback=t_cb,
+    fused_update=True,
+)
+etime = time.time_ns()
+print(f"Time: {(etime-stime)*(1e-9)}")
@@ -15,44 +15,46 @@ from walle_rl.architecture.model import Model
 from walle_rl.common.random import PRNGSequence
 import jax
 from walle_rl.agents.ppo.buffer import PPOBuffer, Batch
-from walle_rl.architecture.ac.core import Actor, ActorCritic, Params
+from walle_rl.agents.ppo.gae import gae_advantages
+from walle_rl.agents.ppo.sweep import SWEEPABLE_LOSS_COEFS, get_learning_rate
+from walle_rl.architecture.ac.core import Actor, ActorCritic, Params, PopulationActorCritic, _population_step, _step
 from walle_rl.agents.base import Policy
-from walle_rl.buffer.buffer import GenericBuffer
+from walle_rl.buffer.buffer import GenericBuffer, gather_batch
+from walle_rl.buffer.prefetch import PrefetchLoader
+from walle_rl.common.compilation import aot_compile, enable_compilation_cache, shape_dtype
 from walle_rl.common.rollout import Rollout
+from walle_rl.envs.base import JaxEnv
 from walle_rl.logger.logger import Logger
 from walle_rl.optim.pg import clipped_surrogate_pg_loss
 import jax.numpy as jnp
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
 import chex
 
-@functools.partial(jax.jit, static_argnames=["gamma", "gae_lambda"])
-@functools.partial(jax.vmap, in_axes=(1, 1, 1, None, None), out_axes=1)
-def gae_advantages(rewards: np.ndarray, dones: np.ndarray, values: np.ndarray, gamma: float, gae_lambda: float):
-    N = len(rewards)
-    advantages = jnp.zeros((N + 1))
-    # advantages = []
-    gae = 0.0
-    not_dones = ~dones
-    
-    value_diffs = gamma * values[1:] * not_dones - values[:-1]
-    deltas = rewards + value_diffs
-
-    # Is this faster?
-    # def body_fun(t, advantages):
-    #     gae = deltas[N - t - 1] + gamma * gae_lambda * not_dones[t] * advantages[t - 1]
-    #     # advantages.append(gae)
-    #     advantages = advantages.at[t].set(gae)
-    #     return advantages
-    # advantages = jax.lax.fori_loop(1, N, body_fun, advantages)
-    
-    # TODO vectorize for loop below
-    def body_fun(gae, t):
-        gae = deltas[t] + gamma * gae_lambda * not_dones[t] * gae
-        return gae, gae
-    indices = jnp.arange(N)[::-1]
-    gae, advantages = jax.lax.scan(body_fun, 0.0, indices,)
-    
-    advantages = advantages[::-1]
-    return jax.lax.stop_gradient(advantages)
+try:
+    from jax import shard_map
+except ImportError:
+    from jax.experimental.shard_map import shard_map
+
+
+# buffers read by the fused updates
+FUSED_BUFFER_KEYS = ["obs_buf", "act_buf", "rew_buf", "val_buf", "logp_buf", "done_buf", "boot_val_buf"]
+
+
+def _masked_mean(x, mask=None):
+    """
+    mean of x over the batch axis, only over the entries marked valid by mask if given, e.g. of a padded Batch
+    """
+    if mask is None:
+        return jnp.mean(x, axis=0)
+    mask = mask.reshape(mask.shape + (1,) * (x.ndim - mask.ndim))
+    return jnp.sum(x * mask, axis=0) / jnp.maximum(mask.sum(), 1)
+
+
+def member_tag(member: int) -> str:
+    """
+    logger tag of the stats of one member of a PopulationActorCritic
+    """
+    return f"train/member_{member}"
 
 @dataclass
 class PPO(Policy):
@@ -73,7 +75,11 @@ class PPO(Policy):
     vf_coef: Optional[float] = 1.0
     dapg_lambda: Optional[float] = 0.1
     dapg_damping: Optional[float] = 0.99
+    # the actor stops being updated for the epoch at the first minibatch whose approximate KL exceeds 1.5 * target_kl,
+    # that minibatch's step included. None to always run all update iterations
     target_kl: Optional[float] = 0.01
+    # "scan", "associative", "auto" or "benchmark", see walle_rl.agents.ppo.gae
+    gae_strategy: Optional[str] = "scan"
     
     def __hash__(self) -> int:
         # TODO neat trick to tell jax this object is hashable and can be made constant
@@ -96,6 +102,9 @@ class PPO(Policy):
         n_epochs=100,
         critic_warmup_epochs=0,
         train_callback: Callable = None,
+        fused_update=False,
+        grad_accum_steps=1,
+        data_parallel=False,
     ):
         # simple wrapped training loop function
         for epoch in range(start_epoch, start_epoch + n_epochs):
@@ -114,6 +123,9 @@ class PPO(Policy):
                 update_iters=update_iters,
                 update_actor=update_actor,
                 update_critic=update_critic,
+                fused_update=fused_update,
+                grad_accum_steps=grad_accum_steps,
+                data_parallel=data_parallel,
             )
             logger.store("train", epoch=epoch, append=False)
             logger.store("train", env_interactions=steps_per_epoch * buffer.n_envs * (epoch + 1), append=False)
@@ -138,8 +150,40 @@ class PPO(Policy):
         update_iters=80,
         update_actor=True,
         update_critic=True,
+        fused_update=False,
+        grad_accum_steps=1,
+        data_parallel=False,
     ):
+        """
+        env : gym.Env, JaxEnv or a pair of vectorized envs
+            A JaxEnv is rolled out with the jitted Rollout.collect_jax. A list of two vectorized envs is rolled out with
+            Rollout.collect_async, overlapping policy inference of one group with env stepping of the other
+
+        fused_update : bool
+            If true, GAE, advantage normalization and all update_iters minibatch updates are run as a single jitted
+            function (see PPO.fused_update) instead of one dispatch and host side shuffle per minibatch
+
+        grad_accum_steps : int
+            Split each minibatch into grad_accum_steps equal micro-batches whose gradients are accumulated before a
+            single optimizer step, bounding peak memory by the micro-batch size. batch_size must be divisible by it
+
+        data_parallel : bool
+            If true, the fused update is run data parallel over jax.local_devices(), see PPO.parallel_update_fn. Each
+            device gets n_envs // n_devices envs of the rollout and batch_size // n_devices samples of each minibatch
+
+        If ac is a PopulationActorCritic, all members are trained at once: acting, GAE and the fused update are vmapped
+        over the members, each member using its block of buffer.n_envs // n_members envs and minibatches of batch_size.
+        Stats are also logged per member under member_tag(member). clip_ratio and ent_coef may then be arrays
+        of shape (n_members,) holding the value of each member, see walle_rl.agents.ppo.sweep
+        """
         rollout = Rollout()
+        population = isinstance(ac, PopulationActorCritic)
+        assert not (population and data_parallel), "populations can't be trained data parallel"
+        for k in SWEEPABLE_LOSS_COEFS:
+            assert population or np.ndim(getattr(self, k)) == 0, f"{k} can only be an array for populations"
+        env_tags = None
+        if population:
+            env_tags = [member_tag(m) for m in ac.member_ids(np.arange(buffer.n_envs), buffer.n_envs)]
 
         def policy(o):
             res = ac.step(key=next(rng), obs=o)
@@ -147,8 +191,16 @@ class PPO(Policy):
             return res
 
         buffer.reset()
+        # (row, env, terminal observation) of the episodes that were truncated during the rollout
+        truncated_episodes = []
 
         def wrapped_rollout_cb(observations, next_observations, pi_output, actions, rewards, infos, dones, timeouts):
+            truncated = np.zeros(buffer.n_envs, dtype=bool)
+            for idx in np.flatnonzero(dones):
+                # envs that don't report truncations are treated as truncated when they end at max_ep_len
+                if infos[idx].get("TimeLimit.truncated", False) or timeouts[idx]:
+                    truncated[idx] = True
+                    truncated_episodes.append((buffer.ptr, idx, infos[idx]["terminal_observation"]))
             buffer.store(
                 obs_buf=observations,
                 act_buf=actions,
@@ -156,6 +208,8 @@ class PPO(Policy):
                 val_buf=pi_output["val"],
                 logp_buf=pi_output["logp_a"],
                 done_buf=dones,
+                trunc_buf=truncated,
+                boot_val_buf=np.zeros(buffer.n_envs, dtype=np.float32),
             )
             if logger is not None:
                 logger.store(tag="train", v_vals=pi_output["val"])
@@ -166,87 +220,846 @@ class PPO(Policy):
 
         # ac.eval()
 
-        # TODO - add jax rollout collection method for gyms like brax and gymnax
-        rollout.collect(
-            policy=policy,
-            env=env,
-            n_envs=buffer.n_envs,
-            steps=steps_per_epoch+1,
-            rollout_callback=wrapped_rollout_cb,
-            max_ep_len=self.max_ep_len,
-            logger=logger,
-            verbose=verbose,
-        )
+        if isinstance(env, JaxEnv):
+            self._collect_jax(rng=rng, ac=ac, buffer=buffer, env=env, steps_per_epoch=steps_per_epoch, logger=logger)
+        elif isinstance(env, (list, tuple)):
+            rollout.collect_async(
+                policy=policy,
+                envs=env,
+                steps=steps_per_epoch+1,
+                rollout_callback=wrapped_rollout_cb,
+                max_ep_len=self.max_ep_len,
+                logger=logger,
+                verbose=verbose,
+                env_tags=env_tags,
+            )
+        else:
+            rollout.collect(
+                policy=policy,
+                env=env,
+                n_envs=buffer.n_envs,
+                steps=steps_per_epoch+1,
+                rollout_callback=wrapped_rollout_cb,
+                max_ep_len=self.max_ep_len,
+                logger=logger,
+                verbose=verbose,
+                env_tags=env_tags,
+            )
+        if truncated_episodes:
+            self._bootstrap_truncated(ac=ac, buffer=buffer, truncated_episodes=truncated_episodes)
         # ac.train()
         update_start_time = time.time_ns()
+        if fused_update or data_parallel or population:
+            self._fused_update_step(
+                rng=rng,
+                ac=ac,
+                buffer=buffer,
+                logger=logger,
+                batch_size=batch_size,
+                update_iters=update_iters,
+                update_actor=update_actor,
+                update_critic=update_critic,
+                grad_accum_steps=grad_accum_steps,
+                data_parallel=data_parallel,
+            )
+        else:
+            self._update_step(
+                ac=ac,
+                buffer=buffer,
+                logger=logger,
+                batch_size=batch_size,
+                update_iters=update_iters,
+                update_actor=update_actor,
+                update_critic=update_critic,
+                grad_accum_steps=grad_accum_steps,
+            )
+        update_end_time = time.time_ns()
+        logger.store("train", update_time=(update_end_time - update_start_time) * 1e-9, append=False)
+
+        # TODO add dapg and make it jittable
+        # if dapg:
+        #     logger.store("train", dapg_lambda=self.dapg_lambda, append=False)
+        #     if update_actor:
+        #         self.dapg_lambda *= self.dapg_damping
+
+    def warmup(
+        self,
+        ac: ActorCritic,
+        buffer: PPOBuffer,
+        batch_size: int,
+        logger: Logger = None,
+        update_iters: int = 80,
+        update_actor: bool = True,
+        update_critic: bool = True,
+        fused_update: bool = False,
+        grad_accum_steps: int = 1,
+        compilation_cache_dir: str = None,
+        min_compile_time_secs: float = 0.0,
+    ) -> Dict[str, float]:
+        """
+        Lowers and compiles the jitted functions of train_step ahead of time for the shapes of ac and buffer, so the first
+        epoch doesn't stall on compilation.
+
+        compilation_cache_dir - if given, JAX's persistent compilation cache is enabled in this directory for the rest
+        of the process, see walle_rl.common.compilation.enable_compilation_cache. Later runs then load the executables
+        from disk and compiling takes a fraction of the time. Only functions taking at least min_compile_time_secs to
+        compile are written to the cache
+
+        The keyword arguments should match the ones later passed to train_step. Covers acting in python environments,
+        GAE, minibatch gathers of device storage and the per minibatch, fused or population updates. Rollouts of JaxEnvs
+        and data parallel updates are compiled at their first call instead
+
+        Returns the seconds spent compiling each function, also stored in logger under the "warmup" tag
+        """
+        if compilation_cache_dir is not None:
+            enable_compilation_cache(compilation_cache_dir, min_compile_time_secs=min_compile_time_secs)
+        population = isinstance(ac, PopulationActorCritic)
+        key = jax.eval_shape(jax.random.PRNGKey, 0)
+        times = dict()
+
+        if isinstance(buffer.obs_shape, dict):
+            obs = {
+                k: jax.ShapeDtypeStruct(
+                    (buffer.n_envs,) + shape, jax.dtypes.canonicalize_dtype(buffer.observation_space[k].dtype)
+                )
+                for k, shape in buffer.obs_shape.items()
+            }
+        else:
+            obs = jax.ShapeDtypeStruct(
+                (buffer.n_envs,) + buffer.obs_shape, jax.dtypes.canonicalize_dtype(buffer.observation_space.dtype)
+            )
+        step_kwargs = dict(
+            key=key,
+            actor_apply_fn=ac.actor.apply_fn,
+            actor_params=ac.actor.params,
+            critic_apply_fn=ac.critic.apply_fn,
+            critic_params=ac.critic.params,
+            obs=obs,
+        )
+        if population:
+            times["step"] = aot_compile(_population_step, n_members=ac.n_members, **step_kwargs)
+        else:
+            times["step"] = aot_compile(_step, **step_kwargs)
+
+        hparams = {k: getattr(self, k) for k in SWEEPABLE_LOSS_COEFS}
+        T = buffer.buffer_size - 1
+        if fused_update or population:
+            static_kwargs = self._fused_static_kwargs(update_iters, update_actor, update_critic, grad_accum_steps)
+            buffers = {k: jax.tree_util.tree_map(shape_dtype, buffer.buffers[k]) for k in FUSED_BUFFER_KEYS}
+            if population:
+                n_members = ac.n_members
+                keys = jax.eval_shape(lambda: jax.random.split(jax.random.PRNGKey(0), n_members))
+                batch_inds = jax.ShapeDtypeStruct((n_members, update_iters, batch_size), jnp.int32)
+                times["population_update"] = aot_compile(
+                    PPO.population_update_fn(batch_size=batch_size, **static_kwargs),
+                    keys,
+                    ac.actor,
+                    ac.critic,
+                    buffers,
+                    batch_inds,
+                    jax.eval_shape(lambda: self._population_hparams(hparams, n_members)),
+                )
+            else:
+                times["fused_update"] = aot_compile(
+                    PPO.fused_update,
+                    key=key,
+                    actor=ac.actor,
+                    critic=ac.critic,
+                    buffers=buffers,
+                    batch_inds=jax.ShapeDtypeStruct((update_iters, batch_size), jnp.int32),
+                    batch_size=batch_size,
+                    **static_kwargs,
+                    **hparams,
+                )
+        else:
+            rewards = buffer.buffers["rew_buf"]
+            times["gae_advantages"] = aot_compile(
+                gae_advantages,
+                shape_dtype(rewards, (T,) + rewards.shape[1:]),
+                shape_dtype(buffer.buffers["done_buf"], (T,) + rewards.shape[1:]),
+                shape_dtype(buffer.buffers["val_buf"]),
+                self.gamma,
+                self.gae_lambda,
+                bootstrap_values=shape_dtype(buffer.buffers["boot_val_buf"], (T,) + rewards.shape[1:]),
+                strategy=self.gae_strategy,
+            )
+            # _update_step replaces the advantages and returns with the T timesteps computed by GAE
+            buffers = jax.tree_util.tree_map(shape_dtype, buffer.buffers)
+            buffers["adv_buf"] = buffers["ret_buf"] = jax.ShapeDtypeStruct((T, buffer.n_envs), jnp.float32)
+            if buffer.storage == "device":
+                ids = jax.ShapeDtypeStruct((batch_size,), jnp.int32)
+                times["gather_batch"] = aot_compile(gather_batch, buffers, ids, ids)
+            batch = Batch(
+                **jax.tree_util.tree_map(lambda v: jax.ShapeDtypeStruct((batch_size,) + v.shape[2:], v.dtype), buffers)
+            )
+            times["early_stop_update_step"] = aot_compile(
+                PPO.early_stop_update_step,
+                actor=ac.actor,
+                critic=ac.critic,
+                actor_active=jax.ShapeDtypeStruct((), jnp.bool_),
+                batch=batch,
+                clip_ratio=self.clip_ratio,
+                update_actor=update_actor,
+                update_critic=update_critic,
+                target_kl=self.target_kl,
+                grad_accum_steps=grad_accum_steps,
+                ent_coef=self.ent_coef,
+            )
+        if logger is not None:
+            logger.store("warmup", append=False, **{f"{k}_compile_time": v for k, v in times.items()})
+            logger.store("warmup", append=False, compile_time=sum(times.values()))
+        return times
+
+    def _bootstrap_truncated(self, ac: ActorCritic, buffer: PPOBuffer, truncated_episodes):
+        """
+        evaluate the terminal observations of all truncated episodes of a rollout with one batched critic call and write
+        their values into boot_val_buf
+        """
+        rows, env_ids, terminal_obs = zip(*truncated_episodes)
+        rows, env_ids = np.array(rows), np.array(env_ids)
+        terminal_obs = jax.tree_util.tree_map(lambda *xs: np.stack(xs), *terminal_obs)
+        # pad to the next power of 2 so the critic only compiles for a few batch sizes
+        n = len(rows)
+        pad = (1 << (n - 1).bit_length()) - n
+        terminal_obs = jax.tree_util.tree_map(
+            lambda x: np.concatenate([x, np.repeat(x[:1], pad, axis=0)]), terminal_obs
+        )
+        if isinstance(ac, PopulationActorCritic):
+            member_ids = ac.member_ids(np.concatenate([env_ids, np.repeat(env_ids[:1], pad)]), buffer.n_envs)
+            values = ac.value(terminal_obs, member_ids)[:n]
+        else:
+            values = ac.value(terminal_obs)[:n]
+        if buffer.storage == "device":
+            buffer.buffers["boot_val_buf"] = buffer.buffers["boot_val_buf"].at[rows, env_ids].set(values)
+        else:
+            buffer.buffers["boot_val_buf"][rows, env_ids] = np.asarray(values)
+
+    def _update_step(
+        self,
+        ac: ActorCritic,
+        buffer: PPOBuffer,
+        logger: Logger,
+        batch_size: int,
+        update_iters: int,
+        update_actor: bool,
+        update_critic: bool,
+        grad_accum_steps: int = 1,
+    ):
         advantages = gae_advantages(
             buffer.buffers["rew_buf"][:-1],
             buffer.buffers["done_buf"][:-1],
             buffer.buffers["val_buf"],
             self.gamma,
             self.gae_lambda,
+            bootstrap_values=buffer.buffers["boot_val_buf"][:-1],
+            strategy=self.gae_strategy,
         )
 
         buffer.buffers["adv_buf"] = advantages
-        returns = advantages + buffer.buffers["val_buf"][-1, :]  # TODO check device?
+        returns = advantages + buffer.buffers["val_buf"][:-1]
         buffer.buffers["ret_buf"] = returns
         # apply normalization trick
         buffer.buffers["adv_buf"] = (buffer.buffers["adv_buf"] - buffer.buffers["adv_buf"].mean()) / (
             buffer.buffers["adv_buf"].std() + 1e-8
         )
-        for update_iter in range(update_iters):
-            batch = buffer.sample_batch(batch_size=batch_size, drop_last_batch=True)
-            # TODO - add grad accumulation,
-            res = PPO.update_parameters_step(
+        # stays on device, so the early stopping check doesn't block on every minibatch
+        actor_active = jnp.array(True)
+        infos = []
+        # the next minibatches are sampled and copied to device in the background while the current one is trained on.
+        # The last row only holds the bootstrap values, so like the fused update only the T rows before it are sampled
+        loader = PrefetchLoader(
+            buffer, batch_size=batch_size, n_batches=update_iters, drop_last_batch=True, n_steps=buffer.size() - 1
+        )
+        for batch in loader:
+            if not update_actor and not update_critic:
+                loader.close()
+                break
+            res = PPO.early_stop_update_step(
                 actor=ac.actor,
                 critic=ac.critic,
+                actor_active=actor_active,
+                batch=batch,
                 clip_ratio=self.clip_ratio,
                 update_actor=update_actor,
                 update_critic=update_critic,
-                batch=batch,
+                target_kl=self.target_kl,
+                grad_accum_steps=grad_accum_steps,
+                ent_coef=self.ent_coef,
             )
+            ac.actor, ac.critic, actor_active = res["new_actor"], res["new_critic"], res["actor_active"]
+            infos.append((res["info_a"], res["info_c"]))
+        if not infos:
+            logger.store("train", actor_update_iters=0, append=False)
+            return
+        # one device to host transfer for the stats of all update iterations
+        infos = jax.device_get(infos)
+        info_a, info_c = jax.tree_util.tree_map(lambda *xs: np.stack(xs), *infos)
+        self._log_update_info(logger, info_a, info_c)
 
-            ac.actor = res["new_actor"]
-            ac.critic = res["new_critic"]
-            info_a, info_c = res["info_a"], res["info_c"]
-            logger.store(
-                "train", critic_loss=info_c["critic_loss"]
+    def _fused_update_step(
+        self,
+        rng: PRNGSequence,
+        ac: ActorCritic,
+        buffer: PPOBuffer,
+        logger: Logger,
+        batch_size: int,
+        update_iters: int,
+        update_actor: bool,
+        update_critic: bool,
+        grad_accum_steps: int = 1,
+        data_parallel: bool = False,
+    ):
+        buffers = {k: buffer.buffers[k] for k in FUSED_BUFFER_KEYS}
+        static_kwargs = self._fused_static_kwargs(update_iters, update_actor, update_critic, grad_accum_steps)
+        # traced so that sweeps over them don't recompile, see walle_rl.agents.ppo.sweep
+        hparams = {k: getattr(self, k) for k in SWEEPABLE_LOSS_COEFS}
+        if data_parallel:
+            n_devices = jax.local_device_count()
+            assert buffer.n_envs % n_devices == 0, f"n_envs {buffer.n_envs} isn't a multiple of the {n_devices} devices"
+            assert batch_size % n_devices == 0, f"batch_size {batch_size} isn't a multiple of the {n_devices} devices"
+            n_local_envs, local_batch_size = buffer.n_envs // n_devices, batch_size // n_devices
+            # every device samples its minibatches from its own envs with the buffer's sampler
+            t, env_ids = buffer.sampler.precompute(
+                n_devices * update_iters, local_batch_size, n_steps=buffer.size() - 1, n_envs=n_local_envs
+            )
+            batch_inds = buffer._to_rows(t) * n_local_envs + env_ids
+            batch_inds = batch_inds.reshape(n_devices, update_iters, local_batch_size)
+            res = PPO.parallel_update_fn(batch_size=local_batch_size, **static_kwargs)(
+                jax.random.split(next(rng), n_devices),
+                ac.actor,
+                ac.critic,
+                buffers,
+                batch_inds,
+                hparams,
+            )
+        elif isinstance(ac, PopulationActorCritic):
+            n_members = ac.n_members
+            n_member_envs = buffer.n_envs // n_members
+            # every member samples its minibatches from its own envs with the buffer's sampler
+            t, env_ids = buffer.sampler.precompute(
+                n_members * update_iters, batch_size, n_steps=buffer.size() - 1, n_envs=n_member_envs
+            )
+            batch_inds = (buffer._to_rows(t) * n_member_envs + env_ids).reshape(n_members, update_iters, batch_size)
+            hparams = self._population_hparams(hparams, n_members)
+            res = PPO.population_update_fn(batch_size=batch_size, **static_kwargs)(
+                jax.random.split(next(rng), n_members),
+                ac.actor,
+                ac.critic,
+                buffers,
+                batch_inds,
+                hparams,
+            )
+        else:
+            # minibatch indices come from the buffer's sampler, over the T timesteps before the GAE bootstrap frame
+            batch_ids, env_ids = buffer.precompute_batch_ids(update_iters, batch_size, n_steps=buffer.size() - 1)
+            res = PPO.fused_update(
+                key=next(rng),
+                actor=ac.actor,
+                critic=ac.critic,
+                buffers=buffers,
+                batch_inds=jnp.asarray(batch_ids * buffer.n_envs + env_ids),
+                batch_size=batch_size,
+                **static_kwargs,
+                **hparams,
             )
+        ac.actor = res["new_actor"]
+        ac.critic = res["new_critic"]
+        # one device to host transfer for the stats of all update iterations
+        info_a, info_c = jax.device_get((res["info_a"], res["info_c"]))
+        if isinstance(ac, PopulationActorCritic):
+            for m in range(ac.n_members):
+                member_info_a, member_info_c = jax.tree_util.tree_map(lambda x: x[m], (info_a, info_c))
+                self._log_update_info(logger, member_info_a, member_info_c, tag=member_tag(m))
+            # the population's stats are also logged together, with the average number of actor updates
+            self._log_update_info(logger, *jax.tree_util.tree_map(lambda x: x.reshape(-1), (info_a, info_c)))
             if info_a is not None:
-                logger.store("train", actor_loss=info_a["loss_pi"], entropy=info_a["entropy"])
+                logger.store("train", actor_update_iters=info_a["updated"].sum() / ac.n_members, append=False)
+            for m, member_hparams in enumerate(self._member_hparams(ac, hparams)):
+                logger.store(member_tag(m), append=False, **member_hparams)
+        else:
+            self._log_update_info(logger, info_a, info_c)
 
-        update_end_time = time.time_ns()
-        logger.store("train", update_time=(update_end_time - update_start_time) * 1e-9, append=False)
+    def _fused_static_kwargs(self, update_iters: int, update_actor: bool, update_critic: bool, grad_accum_steps: int):
+        """
+        the static arguments of PPO.fused_update, population_update_fn and parallel_update_fn
+        """
+        return dict(
+            gamma=self.gamma,
+            gae_lambda=self.gae_lambda,
+            gae_strategy=self.gae_strategy,
+            update_actor=update_actor,
+            update_critic=update_critic,
+            update_iters=update_iters,
+            target_kl=self.target_kl,
+            grad_accum_steps=grad_accum_steps,
+        )
 
-        # TODO add dapg and make it jittable
-        # if dapg:
-        #     logger.store("train", dapg_lambda=self.dapg_lambda, append=False)
-        #     if update_actor:
-        #         self.dapg_lambda *= self.dapg_damping
+    @staticmethod
+    def _population_hparams(hparams: Dict[str, float], n_members: int):
+        # scalars are shared by all members, arrays of shape (n_members,) hold a value per member
+        return {k: jnp.broadcast_to(jnp.asarray(v, jnp.float32), (n_members,)) for k, v in hparams.items()}
+
+    def _log_update_info(self, logger: Logger, info_a, info_c, tag: str = "train"):
+        """
+        log the per iteration stats of a fused update
+        """
+        if info_c is not None:
+            logger.extend(tag, critic_loss=info_c["critic_loss"])
+        actor_update_iters = 0
+        if info_a is not None:
+            # iterations after the early stop didn't update the actor
+            updated = info_a["updated"]
+            actor_update_iters = int(updated.sum())
+            logger.extend(
+                tag,
+                actor_loss=info_a["loss_pi"][updated],
+                entropy=info_a["entropy"][updated],
+                approx_kl=info_a["approx_kl"][updated],
+            )
+        logger.store(tag, actor_update_iters=actor_update_iters, append=False)
+
+    @staticmethod
+    def _member_hparams(ac: PopulationActorCritic, hparams: Dict[str, jnp.ndarray]):
+        """
+        the swept hyperparameters of each member of the population, including the learning rates of optimizers created
+        with optax.inject_hyperparams
+        """
+        hparams = dict(hparams)
+        for name, model in [("actor_lr", ac.actor), ("critic_lr", ac.critic)]:
+            lr = get_learning_rate(model)
+            if lr is not None:
+                hparams[name] = lr
+        hparams = jax.device_get(hparams)
+        return [{k: float(v[m]) for k, v in hparams.items()} for m in range(ac.n_members)]
+
+    def _collect_jax(
+        self, rng: PRNGSequence, ac: ActorCritic, buffer: PPOBuffer, env: JaxEnv, steps_per_epoch: int, logger: Logger = None
+    ):
+        """
+        collect a full epoch of data from a pure-JAX environment in one jitted rollout and write it into the buffer
+        """
+        rollout_start_time = time.time_ns()
+        population = isinstance(ac, PopulationActorCritic)
+        res = Rollout().collect_jax(
+            rng_key=next(rng),
+            policy_params=ac.policy_params,
+            policy=ac.policy_fn,
+            env=env,
+            steps=steps_per_epoch + 1,
+            n_envs=buffer.n_envs // ac.n_members if population else buffer.n_envs,
+            value_fn=ac.value_fn,
+            value_params=ac.critic.params,
+            population=population,
+        )
+        for k, data in res["buffers"].items():
+            if buffer.storage == "device":
+                # keep the rollout on device, no host round trip
+                buffer.buffers[k] = data.astype(buffer.buffers[k].dtype).reshape(buffer.buffers[k].shape)
+            else:
+                buffer.buffers[k][:] = np.asarray(data).reshape(buffer.buffers[k].shape)
+        buffer.ptr, buffer.full = 0, True
+        jax.block_until_ready(buffer.buffers)
+        rollout_end_time = time.time_ns()
+        if logger is not None:
+            dones, ep_rets, ep_lens = jax.device_get((res["buffers"]["done_buf"], res["EpRet"], res["EpLen"]))
+            if dones.any():
+                logger.extend("train", EpRet=ep_rets[dones], EpLen=ep_lens[dones])
+            if population:
+                member_ids = ac.member_ids(np.arange(buffer.n_envs), buffer.n_envs)
+                for m in range(ac.n_members):
+                    member_dones = dones & (member_ids == m)
+                    if not member_dones.any():
+                        continue
+                    logger.extend(member_tag(m), EpRet=ep_rets[member_dones], EpLen=ep_lens[member_dones])
+            logger.store("train", rollout_time=(rollout_end_time - rollout_start_time) * 1e-9, append=False)
+
+    @staticmethod
+    @functools.partial(
+        jax.jit,
+        static_argnames=[
+            "gamma",
+            "gae_lambda",
+            "gae_strategy",
+            "update_actor",
+            "update_critic",
+            "batch_size",
+            "update_iters",
+            "target_kl",
+            "grad_accum_steps",
+            "axis_name",
+        ],
+        donate_argnames=["actor", "critic"],
+    )
+    def fused_update(
+        key: PRNGKey,
+        actor: Model,
+        critic: Model,
+        buffers: Dict[str, ArrayTree],
+        gamma: float,
+        gae_lambda: float,
+        clip_ratio: float,
+        update_actor: bool,
+        update_critic: bool,
+        batch_size: int,
+        update_iters: int,
+        batch_inds: chex.Array = None,
+        gae_strategy: str = "scan",
+        target_kl: float = None,
+        grad_accum_steps: int = 1,
+        axis_name: str = None,
+        ent_coef: float = 0.0,
+    ):
+        """
+        Runs a full PPO update as one XLA program: GAE, advantage normalization, minibatch permutations and all
+        update_iters gradient steps in a lax.scan. The actor and critic are donated, so don't use them after calling this.
+
+        buffers - dict of rollout data of shape (T + 1, n_envs, ...) keyed like the PPOBuffer buffers, the last timestep
+        is only used to bootstrap the values for GAE. If given, boot_val_buf holds the values of the terminal observations
+        of truncated episodes
+
+        batch_inds - optional (update_iters, batch_size) indices into the T * n_envs flattened transitions (t * n_envs + env),
+        e.g. from a Sampler. By default minibatches are drawn without replacement like GenericBuffer.sample_batch with
+        drop_last_batch=True, a new permutation is used every time the data is exhausted. Returns the new actor and critic and the per iteration
+        losses and entropies stacked along the first axis.
+
+        target_kl - if given, the actor is no longer updated from the first iteration whose approximate KL exceeds
+        1.5 * target_kl on. The later iterations don't run the actor's forward and backward pass, info_a["updated"] marks
+        the iterations that updated the actor.
+
+        grad_accum_steps - number of micro-batches each minibatch's gradients are accumulated over, see
+        PPO.update_parameters_step
+
+        axis_name - name of the mapped device axis when run data parallel, see PPO.parallel_update_fn. buffers and
+        batch_inds are then the envs and minibatch indices of one device. GAE stays local to the device's envs, advantage
+        statistics and gradients are averaged over all devices
+
+        clip_ratio, ent_coef - traced, so they can change between calls or be vmapped over without recompiling
+        """
+        bootstrap_values = buffers["boot_val_buf"][:-1] if "boot_val_buf" in buffers else None
+        advantages = gae_advantages(
+            buffers["rew_buf"][:-1],
+            buffers["done_buf"][:-1],
+            buffers["val_buf"],
+            gamma,
+            gae_lambda,
+            bootstrap_values=bootstrap_values,
+            strategy=gae_strategy,
+        )
+        returns = advantages + buffers["val_buf"][:-1]
+        # apply normalization trick
+        adv_mean = advantages.mean()
+        adv_var = jnp.mean(jnp.square(advantages - adv_mean))
+        if axis_name is not None:
+            # statistics over the rollouts of all devices, each holds the same number of samples
+            adv_mean = jax.lax.pmean(adv_mean, axis_name)
+            adv_var = jax.lax.pmean(jnp.mean(jnp.square(advantages - adv_mean)), axis_name)
+        advantages = (advantages - adv_mean) / (jnp.sqrt(adv_var) + 1e-8)
+
+        data = jax.tree_util.tree_map(lambda x: x[:-1], buffers)
+        data["adv_buf"] = advantages
+        data["ret_buf"] = returns
+        data = jax.tree_util.tree_map(lambda x: x.reshape((-1,) + x.shape[2:]), data)
+
+        if batch_inds is None:
+            n_samples = advantages.size
+            n_minibatches = n_samples // batch_size
+            assert n_minibatches > 0, f"batch_size {batch_size} is larger than the {n_samples} samples collected"
+            n_epochs = -(-update_iters // n_minibatches)
+            perms = jax.vmap(lambda k: jax.random.permutation(k, n_samples))(jax.random.split(key, n_epochs))
+            batch_inds = perms[:, : n_minibatches * batch_size].reshape(-1, batch_size)[:update_iters]
+
+        def body_fun(carry, inds):
+            actor, critic, actor_active = carry
+            batch = Batch(**jax.tree_util.tree_map(lambda x: x[inds], data))
+            res = PPO.early_stop_update_step(
+                actor=actor,
+                critic=critic,
+                actor_active=actor_active,
+                batch=batch,
+                clip_ratio=clip_ratio,
+                update_actor=update_actor,
+                update_critic=update_critic,
+                target_kl=target_kl,
+                grad_accum_steps=grad_accum_steps,
+                axis_name=axis_name,
+                ent_coef=ent_coef,
+            )
+            return (res["new_actor"], res["new_critic"], res["actor_active"]), (res["info_a"], res["info_c"])
+
+        (actor, critic, _), (info_a, info_c) = jax.lax.scan(body_fun, (actor, critic, jnp.array(True)), batch_inds)
+        return dict(new_actor=actor, new_critic=critic, info_a=info_a, info_c=info_c)
 
     @staticmethod
-    @functools.partial(jax.jit, static_argnames=["clip_ratio", "update_actor", "update_critic"])
+    @functools.lru_cache(maxsize=None)
+    def population_update_fn(**static_kwargs) -> Callable:
+        """
+        Returns PPO.fused_update with the given static arguments vmapped over the members of a PopulationActorCritic,
+        called as fn(keys, actor, critic, buffers, batch_inds, hparams).
+
+        keys - (n_members, 2) one PRNG key per member
+
+        actor, critic - the stacked models of the population
+
+        buffers - (T + 1, n_envs, ...) rollout data, member i owns the i-th contiguous block of n_envs // n_members envs
+
+        batch_inds - (n_members, update_iters, batch_size) minibatch indices of each member into its own
+        T * (n_envs // n_members) flattened transitions
+
+        hparams - dict of the traced clip_ratio and ent_coef of each member, each of shape (n_members,)
+
+        Returns the stacked new models and per member stats of shape (n_members, update_iters). Cached so it compiles
+        once per setting. Under vmap the early stopping of target_kl masks the actor updates instead of skipping them
+        """
+
+        def update(key, actor, critic, buffers, batch_inds, hparams):
+            return PPO.fused_update(
+                key=key, actor=actor, critic=critic, buffers=buffers, batch_inds=batch_inds, **static_kwargs, **hparams
+            )
+
+        @jax.jit
+        def fn(keys, actor, critic, buffers, batch_inds, hparams):
+            n_members = len(keys)
+
+            def split_members(x):
+                # (T + 1, n_members * n_member_envs, ...) -> (n_members, T + 1, n_member_envs, ...)
+                return jnp.moveaxis(x.reshape((x.shape[0], n_members, -1) + x.shape[2:]), 1, 0)
+
+            buffers = jax.tree_util.tree_map(split_members, buffers)
+            return jax.vmap(update)(keys, actor, critic, buffers, batch_inds, hparams)
+
+        return fn
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def parallel_update_fn(**static_kwargs) -> Callable:
+        """
+        Returns PPO.fused_update with the given static arguments run data parallel over jax.local_devices() with
+        shard_map, called as fn(keys, actor, critic, buffers, batch_inds, hparams).
+
+        keys - (n_devices, 2) one PRNG key per device
+
+        buffers - (T + 1, n_envs, ...) rollout data, each device gets a contiguous block of n_envs // n_devices envs
+
+        batch_inds - (n_devices, update_iters, batch_size // n_devices) minibatch indices of each device into its own
+        T * (n_envs // n_devices) flattened transitions
+
+        hparams - dict of the traced clip_ratio and ent_coef
+
+        The actor and critic are replicated, the returned parameters and stats are the same on every device and are put
+        on the first one. On CPU, multiple devices can be forced with XLA_FLAGS=--xla_force_host_platform_device_count=N.
+        Cached so it compiles once per setting
+        """
+        mesh = Mesh(np.array(jax.local_devices()), ("devices",))
+        n_devices = mesh.size
+
+        def update(keys, actor, critic, buffers, batch_inds, hparams):
+            return PPO.fused_update(
+                key=keys[0],
+                actor=actor,
+                critic=critic,
+                buffers=buffers,
+                batch_inds=batch_inds[0],
+                axis_name="devices",
+                **static_kwargs,
+                **hparams,
+            )
+
+        sharded_update = jax.jit(
+            shard_map(
+                update,
+                mesh=mesh,
+                in_specs=(P("devices"), P(), P(), P(None, "devices"), P("devices"), P()),
+                out_specs=P(),
+            )
+        )
+
+        def fn(keys, actor, critic, buffers, batch_inds, hparams):
+            def put(x, spec):
+                return jax.device_put(x, NamedSharding(mesh, spec))
+
+            assert len(keys) == n_devices, f"got {len(keys)} keys for {n_devices} devices"
+            res = sharded_update(
+                put(keys, P("devices")),
+                put(actor, P()),
+                put(critic, P()),
+                put(buffers, P(None, "devices")),
+                put(batch_inds, P("devices")),
+                put(hparams, P()),
+            )
+            return jax.device_put(res, jax.local_devices()[0])
+
+        return fn
+
+    @staticmethod
+    @functools.partial(
+        jax.jit, static_argnames=["update_actor", "update_critic", "target_kl", "grad_accum_steps", "axis_name"]
+    )
+    def early_stop_update_step(
+        actor: Model,
+        critic: Model,
+        actor_active: jnp.ndarray,
+        batch: Batch,
+        clip_ratio: float,
+        update_actor: bool,
+        update_critic: bool,
+        target_kl: float = None,
+        grad_accum_steps: int = 1,
+        axis_name: str = None,
+        ent_coef: float = 0.0,
+    ):
+        """
+        one gradient step of the critic and, while the on device boolean actor_active is true, of the actor. With
+        target_kl, the actor's step is dropped and actor_active turns false if the approximate KL of the minibatch under
+        the current actor exceeds 1.5 * target_kl, after which the actor's forward and backward pass are skipped. The
+        flag never leaves the device, so callers don't sync on it
+
+        Returns dict(new_actor, new_critic, actor_active, info_a, info_c), info_a["updated"] marks whether the actor was
+        updated. See PPO.update_parameters_step for the other arguments
+        """
+
+        def actor_step(actor, batch, axis_name=axis_name):
+            grads, info_a = PPO.actor_gradients(actor, batch, clip_ratio, grad_accum_steps, axis_name, ent_coef)
+            info_a = dict(loss_pi=info_a["loss_pi"], entropy=info_a["entropy"], approx_kl=info_a["approx_kl"])
+            # the loss is evaluated at the current parameters, so approx_kl is known before the step is applied
+            updated = jnp.array(True) if target_kl is None else info_a["approx_kl"] <= 1.5 * target_kl
+            actor = jax.lax.cond(updated, lambda a: a.apply_gradient(grads=grads), lambda a: a, actor)
+            return actor, info_a, updated
+
+        def skip_actor_step(actor, batch):
+            # the stats don't depend on the device axis, which isn't bound while evaluating the shapes
+            info_a = jax.eval_shape(functools.partial(actor_step, axis_name=None), actor, batch)[1]
+            return actor, jax.tree_util.tree_map(lambda x: jnp.zeros(x.shape, x.dtype), info_a), jnp.array(False)
+
+        info_a = None
+        if update_actor:
+            actor, info_a, actor_active = jax.lax.cond(actor_active, actor_step, skip_actor_step, actor, batch)
+            info_a["updated"] = actor_active
+        res = PPO.update_parameters_step(
+            actor=actor,
+            critic=critic,
+            clip_ratio=clip_ratio,
+            update_actor=False,
+            update_critic=update_critic,
+            batch=batch,
+            grad_accum_steps=grad_accum_steps,
+            axis_name=axis_name,
+        )
+        return dict(
+            new_actor=actor, new_critic=res["new_critic"], actor_active=actor_active, info_a=info_a, info_c=res["info_c"]
+        )
+
+    @staticmethod
+    @functools.partial(
+        jax.jit, static_argnames=["update_actor", "update_critic", "grad_accum_steps", "axis_name"]
+    )
     def update_parameters_step(
-        actor: Model, critic: Model, clip_ratio: float, update_actor: bool, update_critic: bool, batch: Batch
+        actor: Model,
+        critic: Model,
+        clip_ratio: float,
+        update_actor: bool,
+        update_critic: bool,
+        batch: Batch,
+        grad_accum_steps: int = 1,
+        axis_name: str = None,
+        ent_coef: float = 0.0,
     ):
+        """
+        one gradient step of the actor and / or critic on a minibatch. With grad_accum_steps > 1 the minibatch is split
+        into that many equal micro-batches and their gradients are averaged before a single apply_gradient, which gives
+        the same update as one step on the whole minibatch
+
+        axis_name - if given, the gradients and scalar stats are averaged over this mapped device axis before the update
+
+        clip_ratio and ent_coef are traced, so different values don't recompile
+        """
         info_a, info_c = None, None
         new_actor = actor
         new_critic = critic
         if update_actor:
-            grads_a_fn = jax.grad(
-                PPO.actor_loss_fn(clip_ratio=clip_ratio, actor_apply_fn=actor.apply_fn, batch=batch), has_aux=True
-            )
-            grads, info_a = grads_a_fn(actor.params)
+            grads, info_a = PPO.actor_gradients(actor, batch, clip_ratio, grad_accum_steps, axis_name, ent_coef)
             new_actor = actor.apply_gradient(grads=grads)
         if update_critic:
-            grads_c_fn = jax.grad(PPO.critic_loss_fn(critic_apply_fn=critic.apply_fn, batch=batch), has_aux=True)
-            grads, info_c = grads_c_fn(critic.params)
+            grads_c_fn = lambda params, batch: jax.grad(
+                PPO.critic_loss_fn(critic_apply_fn=critic.apply_fn, batch=batch), has_aux=True
+            )(params)
+            grads, info_c = PPO.accumulate_gradients(grads_c_fn, critic.params, batch, grad_accum_steps)
+            grads, info_c = PPO.all_reduce(grads, info_c, axis_name)
             new_critic = critic.apply_gradient(grads=grads)
 
         return dict(new_actor=new_actor, new_critic=new_critic, info_a=info_a, info_c=info_c)
 
     @staticmethod
-    def actor_loss_fn(clip_ratio: float, actor_apply_fn: Callable, batch: Batch):
+    def actor_gradients(
+        actor: Model, batch: Batch, clip_ratio: float, grad_accum_steps: int = 1, axis_name: str = None, ent_coef=0.0
+    ):
+        """
+        the actor's gradients and loss stats on batch, accumulated and averaged over devices as in
+        PPO.update_parameters_step
+        """
+        grads_a_fn = lambda params, batch: jax.grad(
+            PPO.actor_loss_fn(clip_ratio=clip_ratio, actor_apply_fn=actor.apply_fn, batch=batch, ent_coef=ent_coef),
+            has_aux=True,
+        )(params)
+        grads, info_a = PPO.accumulate_gradients(grads_a_fn, actor.params, batch, grad_accum_steps)
+        return PPO.all_reduce(grads, info_a, axis_name)
+
+    @staticmethod
+    def all_reduce(grads: Params, info: Dict, axis_name: str = None):
+        """
+        averages the gradients and scalar stats over the mapped axis axis_name, so every device applies the same update
+        """
+        if axis_name is None:
+            return grads, info
+        grads = jax.lax.pmean(grads, axis_name)
+        info = jax.tree_util.tree_map(lambda x: jax.lax.pmean(x, axis_name) if x.ndim == 0 else x, info)
+        return grads, info
+
+    @staticmethod
+    def accumulate_gradients(grad_fn: Callable, params: Params, batch: Batch, grad_accum_steps: int):
+        """
+        averages the gradients and infos of grad_fn(params, micro_batch) over grad_accum_steps equal micro-batches of
+        batch. The micro-batches are processed one after the other in a lax.scan, so only the activations of one of them
+        are alive at a time. If batch has a mask, micro-batches are weighted by their number of valid entries
+        """
+        if grad_accum_steps == 1:
+            return grad_fn(params, batch)
+        batch_size = len(batch.adv_buf)
+        assert (
+            batch_size % grad_accum_steps == 0
+        ), f"batch_size {batch_size} is not a multiple of grad_accum_steps {grad_accum_steps}"
+        micro_batches = jax.tree_util.tree_map(lambda x: x.reshape((grad_accum_steps, -1) + x.shape[1:]), batch)
+        if batch.mask is None:
+            weights, total = jnp.ones(grad_accum_steps), grad_accum_steps
+        else:
+            # each micro-batch loss is a mean over its valid entries only
+            weights = micro_batches.mask.sum(axis=1).astype(jnp.float32)
+            total = jnp.maximum(weights.sum(), 1)
+
+        def body_fun(grads, xs):
+            micro_batch, weight = xs
+            micro_grads, info = grad_fn(params, micro_batch)
+            return jax.tree_util.tree_map(lambda g, m: g + weight * m, grads, micro_grads), info
+
+        # the first micro-batch initializes the sum, so the carry has the gradients' type also inside a shard_map
+        grads, info = grad_fn(params, jax.tree_util.tree_map(lambda x: x[0], micro_batches))
+        grads = jax.tree_util.tree_map(lambda g: weights[0] * g, grads)
+        grads, infos = jax.lax.scan(
+            body_fun, grads, (jax.tree_util.tree_map(lambda x: x[1:], micro_batches), weights[1:])
+        )
+        infos = jax.tree_util.tree_map(lambda x, xs: jnp.concatenate([x[None], xs]), info, infos)
+        grads = jax.tree_util.tree_map(lambda g: g / total, grads)
+
+        # per micro-batch means are averaged, per sample values are concatenated back into one batch
+        def merge(x):
+            if x.ndim != 1:
+                return x.reshape((-1,) + x.shape[2:])
+            return x.mean(0) if batch.mask is None else jnp.sum(weights * x) / total
+
+        infos = jax.tree_util.tree_map(merge, infos)
+        return grads, infos
+
+    @staticmethod
+    def actor_loss_fn(clip_ratio: float, actor_apply_fn: Callable, batch: Batch, ent_coef: float = 0.0):
         def loss_fn(actor_params: Params):
             obs, act, adv, logp_old = batch.obs_buf, batch.act_buf, batch.adv_buf, batch.logp_buf
             # ac.pi.val()
@@ -256,12 +1069,20 @@ class PPO(Policy):
             # ac.pi.train()
             
             ratio = jnp.exp(logp - logp_old)
-            clip_adv = jax.lax.clamp(1.0 - clip_ratio, ratio, 1.0 + clip_ratio) * adv
-            loss_pi = -jnp.mean(jnp.minimum(ratio * adv, clip_adv), axis=0)
-            entropy = dist.entropy().mean()
+            clip_adv = jnp.clip(ratio, 1.0 - clip_ratio, 1.0 + clip_ratio) * adv
+            # padded entries of a batch from sample_batch(drop_last_batch=False) are left out via its mask
+            loss_pi = -_masked_mean(jnp.minimum(ratio * adv, clip_adv), batch.mask)
+            entropy = _masked_mean(dist.entropy(), batch.mask)
+            approx_kl = jax.lax.stop_gradient(_masked_mean(logp_old - logp, batch.mask))
 
-            info = dict(loss_pi=loss_pi, entropy=entropy, logp_old=logp_old.mean(), clip_adv=clip_adv)
-            return loss_pi, info
+            info = dict(
+                loss_pi=loss_pi,
+                entropy=entropy,
+                approx_kl=approx_kl,
+                logp_old=_masked_mean(logp_old, batch.mask),
+                clip_adv=clip_adv,
+            )
+            return loss_pi - ent_coef * entropy, info
 
         return loss_fn
 
@@ -271,7 +1092,7 @@ class PPO(Policy):
             obs, ret = batch.obs_buf, batch.ret_buf
             v = critic_apply_fn(critic_params, obs)
             v = jnp.squeeze(v, -1)
-            critic_loss = jnp.mean(jnp.square(v - ret), axis=0)
+            critic_loss = _masked_mean(jnp.square(v - ret), batch.mask)
             return critic_loss, dict(critic_loss=critic_loss)
 
         return loss_fn
@@ -1,6 +1,7 @@
 from typing import TypedDict
 from gym import spaces
 from walle_rl.buffer.buffer import GenericBuffer
+from walle_rl.buffer.sampler import Sampler
 from walle_rl.common.utils import get_action_dim, get_obs_shape
 from walle_rl.common.stats import discount_cumsum
 import numpy as np
@@ -16,6 +17,10 @@ class Batch:
     val_buf: np.array
     logp_buf: np.array
     done_buf: np.array
+    trunc_buf: np.array = None
+    boot_val_buf: np.array = None
+    # valid entries of a batch padded to a fixed size, see GenericBuffer.sample_batch
+    mask: np.array = None
 class PPOBuffer(GenericBuffer):
     """
     A buffer for storing trajectories experienced by a PPO agent interacting
@@ -30,8 +35,18 @@ class PPOBuffer(GenericBuffer):
         action_space: spaces.Space,
         n_envs: int = 1,
         gamma=0.99,
-        lam=0.95
+        lam=0.95,
+        storage: str = "numpy",
+        storage_path: str = None,
+        sampler: Sampler = None,
     ):
+        """
+        storage - "numpy", "device" or "memmap", see GenericBuffer. With "device" the rollout data stays on the jax device
+
+        storage_path - directory of the "memmap" storage files
+
+        sampler - minibatch Sampler, see GenericBuffer
+        """
         self.observation_space = observation_space
         self.action_space = action_space
         self.obs_shape = get_obs_shape(observation_space)
@@ -47,28 +62,36 @@ class PPOBuffer(GenericBuffer):
             ret_buf = ((), np.float32),
             val_buf = ((), np.float32),
             logp_buf = ((), np.float32),
-            done_buf = ((), np.bool8)
+            done_buf = ((), np.bool8),
+            # episodes that ended by a timeout and the value of their terminal observation, to bootstrap from in GAE
+            trunc_buf = ((), np.bool_),
+            boot_val_buf = ((), np.float32),
         )
         
         if isinstance(self.obs_shape, dict):
             buffer_config["obs_buf"] = (self.obs_shape, {k: self.observation_space[k].dtype for k in self.observation_space})
         else:
-            buffer_config["obs_buf"] = (self.obs_shape, np.float32)
+            # pixel observations keep their uint8 dtype, everything else is stored as float32
+            obs_dtype = np.uint8 if self.observation_space.dtype == np.uint8 else np.float32
+            buffer_config["obs_buf"] = (self.obs_shape, obs_dtype)
         super().__init__(
             buffer_size=buffer_size + 1, # add one to buffer size to store one more frame for GAE computation
             n_envs=n_envs,
-            config=buffer_config
+            config=buffer_config,
+            storage=storage,
+            storage_path=storage_path,
+            sampler=sampler,
         )
 
         self.gamma, self.lam = gamma, lam
         self.ptr, self.path_start_idx, self.max_size = 0, [0] * n_envs, self.buffer_size
         self.next_batch_idx = 0
 
-    def sample_batch(self, batch_size: int, drop_last_batch=True) -> Batch:
-        batch = super().sample_batch(batch_size, drop_last_batch)
+    def sample_batch(self, batch_size: int, drop_last_batch=True, n_steps: int = None) -> Batch:
+        batch = super().sample_batch(batch_size, drop_last_batch, n_steps=n_steps)
         return Batch(**batch)
-    def sample_random_batch(self, batch_size: int) -> Batch:
-        batch = super().sample_random_batch(batch_size)
+    def sample_random_batch(self, batch_size: int, n_steps: int = None) -> Batch:
+        batch = super().sample_random_batch(batch_size, n_steps=n_steps)
         return Batch(**batch)
 
     def finish_path(self, env_id, last_val=0):
@@ -0,0 +1,134 @@
+"""
+Generalized advantage estimation over (T, n_envs) rollouts.
+
+The advantages follow the linear recurrence A_t = delta_t + gamma * lambda * (1 - done_t) * A_{t+1}, which is computed
+with one of two strategies
+
+    scan - sequential lax.scan over the T timesteps, vmapped over envs
+
+    associative - lax.associative_scan over the affine maps A -> delta_t + c_t * A, O(log T) depth
+
+The sequential scan is cheaper on CPU and for short rollouts, the associative scan can win for long horizons on
+accelerators. strategy="auto" picks one with a fixed rule on the (T, n_envs) shape and backend, see auto_gae_strategy,
+so the same kernel and float results are used by every run. strategy="benchmark" instead times both strategies once per
+shape, see select_gae_strategy, which costs extra compiles and depends on timing noise.
+"""
+
+import functools
+import time
+from typing import Dict, Sequence
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+GAE_STRATEGIES = ["scan", "associative", "auto", "benchmark"]
+
+# shortest rollouts for which strategy="auto" uses the associative scan on accelerators. scripts/benchmark_gae.py
+# compares both strategies on the current device
+ASSOCIATIVE_MIN_T = 1024
+
+
+@functools.partial(jax.jit, static_argnames=["gamma", "gae_lambda", "strategy"])
+def gae_advantages(
+    rewards: np.ndarray,
+    dones: np.ndarray,
+    values: np.ndarray,
+    gamma: float,
+    gae_lambda: float,
+    bootstrap_values: np.ndarray = None,
+    strategy: str = "scan",
+):
+    """
+    GAE over (T, n_envs) rollouts, values has T + 1 timesteps.
+
+    bootstrap_values - optional (T, n_envs) value of the next state at steps where an episode ended, i.e. the value of the
+    terminal observation of truncated episodes and 0 for terminated ones. Defaults to 0 everywhere, treating timeouts as
+    terminal.
+
+    strategy - "scan", "associative", "auto" or "benchmark", see the module docstring
+    """
+    assert strategy in GAE_STRATEGIES, f"strategy must be one of {GAE_STRATEGIES}, got {strategy}"
+    if strategy == "auto":
+        strategy = auto_gae_strategy(*rewards.shape[:2])
+    elif strategy == "benchmark":
+        strategy = select_gae_strategy(*rewards.shape[:2])
+    if bootstrap_values is None:
+        bootstrap_values = jnp.zeros_like(values[:-1])
+    not_dones = ~dones
+    # the next value is the value of the reset observation at a done, so bootstrap from the terminal observation instead
+    value_diffs = gamma * jnp.where(dones, bootstrap_values, values[1:]) - values[:-1]
+    deltas = rewards + value_diffs
+    discounts = gamma * gae_lambda * not_dones
+    if strategy == "scan":
+        advantages = _gae_scan(deltas, discounts)
+    else:
+        advantages = _gae_associative(deltas, discounts)
+    return jax.lax.stop_gradient(advantages)
+
+
+@functools.partial(jax.vmap, in_axes=(1, 1), out_axes=1)
+def _gae_scan(deltas, discounts):
+    def body_fun(gae, t):
+        gae = deltas[t] + discounts[t] * gae
+        return gae, gae
+
+    indices = jnp.arange(len(deltas))[::-1]
+    # zeros_like keeps the carry's type in line with the deltas, e.g. when varying over a shard_map device axis
+    _, advantages = jax.lax.scan(body_fun, jnp.zeros_like(deltas[0]), indices)
+    return advantages[::-1]
+
+
+def _gae_associative(deltas, discounts):
+    # with reverse=True, a accumulates the timesteps after the ones in b. Composing A -> d_b + c_b * (d_a + c_a * A)
+    def combine(a, b):
+        c_a, d_a = a
+        c_b, d_b = b
+        return c_a * c_b, d_b + c_b * d_a
+
+    _, advantages = jax.lax.associative_scan(combine, (discounts, deltas), reverse=True)
+    return advantages
+
+
+def benchmark_gae(
+    T: int, n_envs: int, strategies: Sequence[str] = ("scan", "associative"), repeats: int = 5
+) -> Dict[str, float]:
+    """
+    returns the fastest of repeats runtimes in seconds of each GAE strategy on (T, n_envs) rollouts, excluding compilation
+    """
+    times = dict()
+    # run eagerly even if called while tracing a jitted function
+    with jax.ensure_compile_time_eval():
+        rewards = jnp.zeros((T, n_envs))
+        dones = jnp.zeros((T, n_envs), dtype=bool)
+        values = jnp.zeros((T + 1, n_envs))
+        for strategy in strategies:
+            run = functools.partial(gae_advantages, rewards, dones, values, 0.99, 0.95, strategy=strategy)
+            jax.block_until_ready(run())
+            best = np.inf
+            for _ in range(repeats):
+                stime = time.perf_counter()
+                jax.block_until_ready(run())
+                best = min(best, time.perf_counter() - stime)
+            times[strategy] = best
+    return times
+
+
+def auto_gae_strategy(T: int, n_envs: int, backend: str = None) -> str:
+    """
+    the GAE strategy for (T, n_envs) rollouts on backend, defaulting to the default backend. The associative scan only
+    for rollouts of at least ASSOCIATIVE_MIN_T timesteps on GPU or TPU, on CPU the sequential scan is faster for nearly all shapes
+    """
+    backend = jax.default_backend() if backend is None else backend
+    if backend != "cpu" and T >= ASSOCIATIVE_MIN_T:
+        return "associative"
+    return "scan"
+
+
+@functools.lru_cache(maxsize=None)
+def select_gae_strategy(T: int, n_envs: int) -> str:
+    """
+    the fastest GAE strategy for (T, n_envs) rollouts on the default device. Benchmarked once per shape
+    """
+    times = benchmark_gae(T, n_envs)
+    return min(times, key=times.get)
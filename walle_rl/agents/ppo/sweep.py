@@ -0,0 +1,119 @@
+"""
+Hyperparameter sweeps trained as a single PopulationActorCritic.
+
+The loss coefficients clip_ratio and ent_coef are traced by the fused PPO updates, so a PPO whose fields hold arrays of
+shape (n_members,) gives every member its own value while all members share one compiled update. Learning rates are
+swept by creating the optimizers with optax.inject_hyperparams, which keeps the learning rate in the optimizer state
+where it is stacked like any other member state.
+
+vf_coef is not sweepable: the critic has its own loss and optimizer, and scale invariant optimizers like Adam train
+the same critic for any scaling of its loss. Sweep critic_lr instead.
+
+    ppo, ac, members = create_sweep(
+        rng, PPO(max_ep_len=500), dict(clip_ratio=[0.1, 0.2], actor_lr=[1e-4, 3e-4]), n_seeds=2, actor=..., ...
+    )
+    ppo.train_loop(rng=rng, ac=ac, buffer=buffer, env=env, fused_update=True, ...)
+
+buffer and env need n_members * n_envs_per_member envs. Each member's metrics and hyperparameters are logged under
+walle_rl.agents.ppo.agent.member_tag(member).
+"""
+
+import dataclasses
+import itertools
+from typing import Callable, Dict, Optional, Sequence
+
+import flax.linen as nn
+import jax.numpy as jnp
+import numpy as np
+import optax
+
+from walle_rl.architecture.ac.core import PopulationActorCritic
+from walle_rl.architecture.model import Model
+from walle_rl.common.random import PRNGSequence
+
+SWEEPABLE_LOSS_COEFS = ["clip_ratio", "ent_coef"]
+SWEEPABLE_LEARNING_RATES = ["actor_lr", "critic_lr"]
+SWEEPABLE = SWEEPABLE_LOSS_COEFS + SWEEPABLE_LEARNING_RATES
+
+
+def grid_members(grid: Dict[str, Sequence[float]], n_seeds: int = 1) -> Dict[str, np.ndarray]:
+    """
+    the cartesian product of the grid, each combination repeated for n_seeds consecutive members. Returns a dict of
+    (n_combinations * n_seeds,) float32 arrays
+    """
+    for k in grid:
+        assert k in SWEEPABLE, f"can only sweep over {SWEEPABLE}, got {k}"
+    combinations = list(itertools.product(*grid.values()))
+    return {
+        k: np.repeat(np.array([c[i] for c in combinations], dtype=np.float32), n_seeds) for i, k in enumerate(grid)
+    }
+
+
+def get_learning_rate(model: Model) -> Optional[jnp.ndarray]:
+    """
+    the learning rate in the optimizer state of model, or None if its optimizer wasn't created with
+    optax.inject_hyperparams
+    """
+    hyperparams = getattr(model.opt_state, "hyperparams", None)
+    if hyperparams is None:
+        return None
+    return hyperparams.get("learning_rate")
+
+
+def set_learning_rate(model: Model, learning_rate) -> Model:
+    """
+    returns model with the learning rate in its optimizer state replaced, a scalar or an array with a value per member
+    of a population. The optimizer must be created with optax.inject_hyperparams
+    """
+    current = get_learning_rate(model)
+    assert current is not None, "the optimizer must be created with optax.inject_hyperparams to set its learning rate"
+    learning_rate = jnp.broadcast_to(jnp.asarray(learning_rate, dtype=current.dtype), current.shape)
+    hyperparams = dict(model.opt_state.hyperparams, learning_rate=learning_rate)
+    return model.replace(opt_state=model.opt_state._replace(hyperparams=hyperparams))
+
+
+def create_sweep(
+    rng: PRNGSequence,
+    ppo,
+    grid: Dict[str, Sequence[float]],
+    actor: nn.Module,
+    critic: nn.Module,
+    explorer,
+    sample_obs,
+    act_dims,
+    n_seeds: int = 1,
+    actor_optim: Callable[..., optax.GradientTransformation] = optax.adam,
+    critic_optim: Callable[..., optax.GradientTransformation] = optax.adam,
+    actor_lr: float = 3e-4,
+    critic_lr: float = 1e-3,
+):
+    """
+    creates a population with one member per combination of the grid and seed, see grid_members.
+
+    grid - maps each swept hyperparameter, out of SWEEPABLE, to its values. Hyperparameters that aren't swept keep the
+    value of ppo, or actor_lr and critic_lr
+
+    actor_optim, critic_optim - optax optimizer constructors taking a learning_rate, e.g. optax.adam
+
+    Returns (ppo, ac, members): a copy of ppo holding the per member loss coefficients, the PopulationActorCritic and
+    the dict of swept values of each member
+    """
+    members = grid_members(grid, n_seeds)
+    n_members = len(next(iter(members.values()))) if members else n_seeds
+    ac = PopulationActorCritic(
+        rng=rng,
+        n_members=n_members,
+        actor=actor,
+        critic=critic,
+        explorer=explorer,
+        sample_obs=sample_obs,
+        act_dims=act_dims,
+        actor_optim=optax.inject_hyperparams(actor_optim)(learning_rate=actor_lr),
+        critic_optim=optax.inject_hyperparams(critic_optim)(learning_rate=critic_lr),
+    )
+    if "actor_lr" in members:
+        ac.actor = set_learning_rate(ac.actor, members["actor_lr"])
+    if "critic_lr" in members:
+        ac.critic = set_learning_rate(ac.critic, members["critic_lr"])
+    ppo = dataclasses.replace(ppo, **{k: v for k, v in members.items() if k in SWEEPABLE_LOSS_COEFS})
+    return ppo, ac, members
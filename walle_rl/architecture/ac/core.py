@@ -53,6 +53,14 @@ class Actor(nn.Module):
         return dist, a
 
 
+def _policy_step(actor_apply_fn: Callable, critic_apply_fn: Callable, key, params: Tuple[Params, Params], obs):
+    """
+    pure policy function that can be traced inside of jitted rollouts. params is a tuple of (actor_params, critic_params)
+    """
+    actor_params, critic_params = params
+    return _step(key, actor_apply_fn, actor_params, critic_apply_fn, critic_params, obs)
+
+
 @functools.partial(jax.jit, static_argnames=["actor_apply_fn", "critic_apply_fn"])
 def _step(key, actor_apply_fn: Callable, actor_params: Params, critic_apply_fn: Callable, critic_params: Params, obs: np.ndarray):
     dist, _ = actor_apply_fn(actor_params, obs)
@@ -65,6 +73,14 @@ def _step(key, actor_apply_fn: Callable, actor_params: Params, critic_apply_fn:
     return dict(actions=a, val=v, logp_a=logp_a)
 
 
+@functools.partial(jax.jit, static_argnames=["critic_apply_fn"])
+def _value(critic_apply_fn: Callable, critic_params: Params, obs: np.ndarray):
+    """
+    pure value function that can be traced inside of jitted rollouts
+    """
+    return jnp.squeeze(critic_apply_fn(critic_params, obs), -1)
+
+
 class ActorCritic:
     actor: Model
     critic: Model
@@ -83,6 +99,16 @@ class ActorCritic:
         actor_module = Actor(actor=actor, explorer=explorer)
         self.actor = Model.create(model=actor_module, key=next(rng), sample_input=sample_obs, optimizer=actor_optim)
         self.critic = Model.create(model=critic, key=next(rng), sample_input=sample_obs, optimizer=critic_optim)
+        # created once so that jitted rollouts taking it as a static argument don't recompile
+        self.policy_fn = functools.partial(_policy_step, self.actor.apply_fn, self.critic.apply_fn)
+        self.value_fn = functools.partial(_value, self.critic.apply_fn)
+
+    @property
+    def policy_params(self) -> Tuple[Params, Params]:
+        return (self.actor.params, self.critic.params)
+
+    def value(self, obs):
+        return self.value_fn(self.critic.params, obs)
 
     def step(self, key, obs):
         res = _step(
@@ -107,3 +133,110 @@ class ActorCritic:
         dist: distrax.Distribution = self.actor(obs, method=self.actor.model._distribution)
         # TODO remove np array here
         return np.array(dist.sample(seed=key))
+
+
+@functools.partial(jax.jit, static_argnames=["actor_apply_fn", "critic_apply_fn", "n_members"])
+def _population_step(
+    key,
+    actor_apply_fn: Callable,
+    actor_params: Params,
+    critic_apply_fn: Callable,
+    critic_params: Params,
+    obs,
+    n_members: int,
+):
+    # (n_members * n_envs, ...) -> (n_members, n_envs, ...), each member acts on its own block of envs
+    obs = jax.tree_util.tree_map(lambda x: x.reshape((n_members, -1) + x.shape[1:]), obs)
+    res = jax.vmap(lambda k, a_params, c_params, o: _step(k, actor_apply_fn, a_params, critic_apply_fn, c_params, o))(
+        jax.random.split(key, n_members), actor_params, critic_params, obs
+    )
+    return jax.tree_util.tree_map(lambda x: x.reshape((-1,) + x.shape[2:]), res)
+
+
+@functools.partial(jax.jit, static_argnames=["critic_apply_fn"])
+def _population_value(critic_apply_fn: Callable, critic_params: Params, obs, member_ids):
+    # few observations, e.g. terminal observations, so every member evaluates all of them and the owner's value is kept
+    values = jax.vmap(lambda params: _value(critic_apply_fn, params, obs))(critic_params)
+    return values[member_ids, jnp.arange(len(member_ids))]
+
+
+class PopulationActorCritic:
+    """
+    A population of n_members ActorCritics with the same architecture and optimizers, e.g. to train several seeds in one
+    program. The params and optimizer states of all members are stacked along a leading axis of actor and critic, and
+    acting, GAE and updates are vmapped over it.
+
+    Environments are split into contiguous blocks, with n_envs vectorized envs member i owns envs
+    [i * n_envs // n_members, (i + 1) * n_envs // n_members).
+
+    policy_fn and value_fn are the functions of a single member, to be vmapped over the stacked params
+    """
+
+    actor: Model
+    critic: Model
+
+    def __init__(
+        self,
+        rng: PRNGSequence,
+        n_members: int,
+        actor: nn.Module,
+        critic: nn.Module,
+        explorer,
+        sample_obs,
+        act_dims,
+        actor_optim: optax.GradientTransformation,
+        critic_optim: optax.GradientTransformation,
+    ) -> None:
+        self.n_members = n_members
+        actor_module = Actor(actor=actor, explorer=explorer)
+
+        def create(model, key, optimizer):
+            keys = jax.random.split(key, n_members)
+            return jax.vmap(
+                lambda k: Model.create(model=model, key=k, sample_input=sample_obs, optimizer=optimizer)
+            )(keys)
+
+        self.actor = create(actor_module, next(rng), actor_optim)
+        self.critic = create(critic, next(rng), critic_optim)
+        self.policy_fn = functools.partial(_policy_step, self.actor.apply_fn, self.critic.apply_fn)
+        self.value_fn = functools.partial(_value, self.critic.apply_fn)
+
+    @property
+    def policy_params(self) -> Tuple[Params, Params]:
+        return (self.actor.params, self.critic.params)
+
+    def member_ids(self, env_ids, n_envs: int):
+        """
+        the member owning each of env_ids out of n_envs envs
+        """
+        return np.asarray(env_ids) // (n_envs // self.n_members)
+
+    def step(self, key, obs):
+        """
+        acts on the (n_members * n_envs_per_member, ...) observations of all envs
+        """
+        return _population_step(
+            key=key,
+            actor_apply_fn=self.actor.apply_fn,
+            actor_params=self.actor.params,
+            critic_apply_fn=self.critic.apply_fn,
+            critic_params=self.critic.params,
+            obs=obs,
+            n_members=self.n_members,
+        )
+
+    def value(self, obs, member_ids):
+        """
+        values of a batch of observations, each evaluated by the critic of the member in member_ids
+        """
+        return _population_value(self.critic.apply_fn, self.critic.params, obs, member_ids)
+
+    def member(self, idx: int) -> ActorCritic:
+        """
+        returns a standalone ActorCritic holding the params and optimizer states of member idx, e.g. for evaluation
+        """
+        ac = ActorCritic.__new__(ActorCritic)
+        ac.actor = jax.tree_util.tree_map(lambda x: x[idx], self.actor)
+        ac.critic = jax.tree_util.tree_map(lambda x: x[idx], self.critic)
+        ac.policy_fn, ac.value_fn = self.policy_fn, self.value_fn
+        return ac
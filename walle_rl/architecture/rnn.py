@@ -0,0 +1,116 @@
+from typing import Any, Callable, Sequence
+
+import distrax
+import flax.linen as nn
+import jax
+import jax.numpy as jnp
+
+CELL_TYPES = ["lstm", "gru"]
+
+
+def _make_cell(cell: str, hidden_size: int) -> nn.Module:
+    if cell == "lstm":
+        return nn.OptimizedLSTMCell(features=hidden_size)
+    return nn.GRUCell(features=hidden_size)
+
+
+def initialize_carry(batch_size: int, hidden_size: int, cell: str = "lstm") -> Any:
+    """
+    zero recurrent state of a batch of sequences. (c, h) for an LSTM, h for a GRU
+    """
+    h = jnp.zeros((batch_size, hidden_size))
+    if cell == "lstm":
+        return (h, h)
+    return h
+
+
+class _ResetCell(nn.Module):
+    """
+    recurrent cell that zeros the carry of sequences whose episode restarts at this timestep
+    """
+
+    cell: str
+    hidden_size: int
+
+    @nn.compact
+    def __call__(self, carry, inputs):
+        x, resets = inputs
+        carry = jax.tree_util.tree_map(lambda c: jnp.where(resets[:, None], jnp.zeros_like(c), c), carry)
+        return _make_cell(self.cell, self.hidden_size)(carry, x)
+
+
+class RNN(nn.Module):
+    """
+    Initialize a recurrent network over (B, T, ...) sequences, e.g. the windows of GenericBuffer.sample_sequences. Each
+    timestep is encoded by an MLP, the cell is unrolled over time with nn.scan and a Dense layer maps the hidden states to
+    the outputs. For a single rollout step pass sequences of length 1 along with the carry of the previous step.
+
+    Parameters
+    ----------
+    hidden_size - size of the recurrent state
+
+    out_features - size of the output at each timestep
+
+    features - hidden units of each layer of the MLP encoder
+
+    cell - "lstm" or "gru"
+
+    activation - activation of the MLP encoder
+
+    Calling returns (outputs, carry). carry defaults to zeros, resets is an optional (B, T) boolean array marking where
+    episodes start and the carry is zeroed
+    """
+
+    hidden_size: int
+    out_features: int
+    features: Sequence[int] = ()
+    cell: str = "lstm"
+    activation: Callable[[jnp.ndarray], jnp.ndarray] = nn.relu
+
+    @nn.compact
+    def __call__(self, x, carry=None, resets=None):
+        assert self.cell in CELL_TYPES, f"cell must be one of {CELL_TYPES}, got {self.cell}"
+        for feat in self.features:
+            x = self.activation(nn.Dense(feat)(x))
+        if carry is None:
+            carry = initialize_carry(x.shape[0], self.hidden_size, self.cell)
+        if resets is None:
+            resets = jnp.zeros(x.shape[:2], dtype=bool)
+        scan_cell = nn.scan(
+            _ResetCell, variable_broadcast="params", split_rngs={"params": False}, in_axes=1, out_axes=1
+        )
+        carry, h = scan_cell(cell=self.cell, hidden_size=self.hidden_size)(carry, (x, resets))
+        return nn.Dense(self.out_features)(h), carry
+
+
+class RecurrentActor(nn.Module):
+    """
+    Recurrent counterpart of Actor. Returns the action distribution and raw actor outputs at every timestep and the
+    final carry
+    """
+
+    rnn: RNN
+    explorer: nn.Module
+
+    def __hash__(self) -> int:
+        return id(self)
+
+    def __call__(self, x, carry=None, resets=None):
+        a, carry = self.rnn(x, carry, resets)
+        dist: distrax.Distribution = self.explorer(a)
+        return dist, a, carry
+
+
+class RecurrentCritic(nn.Module):
+    """
+    Recurrent value function. Returns values of shape (B, T) and the final carry
+    """
+
+    rnn: RNN
+
+    def __hash__(self) -> int:
+        return id(self)
+
+    def __call__(self, x, carry=None, resets=None):
+        v, carry = self.rnn(x, carry, resets)
+        return jnp.squeeze(v, -1), carry
@@ -2,8 +2,10 @@
 Adapted from SB3
 """
 
+import os.path as osp
 from abc import ABC, abstractmethod
 from functools import partial
+from pathlib import Path
 from typing import Any, Dict, List, Optional, Union
 
 import jax.numpy as jnp
@@ -12,6 +14,7 @@ import jax
 from gym import spaces
 from flax import struct
 
+from walle_rl.buffer.sampler import PermutationSampler, RandomSampler, Sampler
 from walle_rl.common.utils import get_action_dim, get_obs_shape
 
 
@@ -55,22 +58,103 @@ class BaseBuffer(ABC):
         """
         self.ptr = 0
         self.full = False
+
+
+@partial(jax.jit, donate_argnums=(0,))
+def _device_store(buffers, data, ptr):
+    """
+    write one timestep of data into the device buffers at index ptr. The buffers are donated so XLA can update them in place
+    """
+
+    def update(buf, d):
+        d = jnp.asarray(d, dtype=buf.dtype).reshape((1,) + buf.shape[1:])
+        return jax.lax.dynamic_update_slice(buf, d, (ptr,) + (0,) * (buf.ndim - 1))
+
+    return jax.tree_util.tree_map(update, buffers, data)
+
+
+@partial(jax.jit, donate_argnums=(0,))
+def _device_store_many(buffers, data, ptr):
+    """
+    write k timesteps of data into the device buffers starting at index ptr, wrapping around the end of the buffers
+    """
+
+    def update(buf, d):
+        d = jnp.asarray(d, dtype=buf.dtype).reshape((-1,) + buf.shape[1:])
+        rows = (ptr + jnp.arange(d.shape[0])) % buf.shape[0]
+        return buf.at[rows].set(d)
+
+    return jax.tree_util.tree_map(update, buffers, data)
+
+
+# number of times gather_batch has been traced, i.e. compiled
+_gather_traces = 0
+
+
+@jax.jit
+def gather_batch(buffers, batch_ids, env_ids):
+    """
+    gather the (batch_ids, env_ids) entries of a pytree of (buffer_size, n_envs, ...) arrays. Being a pure module level
+    function, it is compiled once per buffer layout and batch size instead of once per buffer object
+    """
+    global _gather_traces
+    _gather_traces += 1
+    return jax.tree_util.tree_map(lambda x: x[batch_ids, env_ids], buffers)
+
+
+def _pad_to_bucket(batch_ids: np.ndarray, env_ids: np.ndarray, bucket_size: int):
+    """
+    pad indices to bucket_size by repeating the first index. Returns the padded indices and the mask of valid entries
+    """
+    n = len(batch_ids)
+    mask = np.arange(bucket_size) < n
+    if n < bucket_size:
+        batch_ids = np.concatenate([batch_ids, np.full(bucket_size - n, batch_ids[0])])
+        env_ids = np.concatenate([env_ids, np.full(bucket_size - n, env_ids[0])])
+    return batch_ids, env_ids, mask
+
+
 class GenericBuffer(BaseBuffer):
     """
     Generic buffer that stores key value items for vectorized environment outputs.
     """
 
+    STORAGE_TYPES = ["numpy", "device", "memmap"]
+
     def __init__(
         self,
         buffer_size: int,
         device = "cpu",
         n_envs: int = 1,
-        config=dict() 
+        config=dict(),
+        storage: str = "numpy",
+        storage_path: str = None,
+        sampler: Sampler = None,
+        done_key: str = "done_buf",
     ):
         """
         
         config - dict(k->v) where k is buffer name and v[0] is shape, v[1] is numpy dtype, v[2] is data is dict or not. if is_dict, then shape and dtype should be a dict of shapes and dtypes
+
+        storage - where the buffers live. "numpy" stores numpy arrays in host memory. "device" stores jax arrays on the
+        default jax device, writes are done in place by jitted store steps and sampled batches never leave the device.
+        "memmap" stores each buffer as a file-backed np.memmap (a .npy file) under storage_path, for buffers that don't
+        fit in memory such as large uint8 pixel observations
+
+        storage_path - directory for the "memmap" storage files, e.g. osp.join(logger.exp_path, "buffer")
+
+        sampler - Sampler used by sample_batch, defaults to a PermutationSampler seeded from np.random so that np.random.seed
+        keeps runs reproducible. sample_random_batch draws from the same random generator
+
+        done_key - buffer that marks the last timestep of an episode, which sample_sequences uses to keep windows within
+        a single episode
         """
+        assert storage in self.STORAGE_TYPES, f"storage must be one of {self.STORAGE_TYPES}, got {storage}"
+        self.storage = storage
+        self.storage_path = storage_path
+        if storage == "memmap":
+            assert storage_path is not None, "memmap storage requires a storage_path"
+            Path(storage_path).mkdir(parents=True, exist_ok=True)
         super().__init__(
             buffer_size=buffer_size,
             device=device,
@@ -88,19 +172,36 @@ class GenericBuffer(BaseBuffer):
             if is_dict:
                 self.buffers[k] = dict()
                 for part_key in shape.keys():
-                    self.buffers[k][part_key] = np.zeros((self.buffer_size, self.n_envs) + shape[part_key], dtype=dtype[part_key])
+                    self.buffers[k][part_key] = self._zeros(
+                        (self.buffer_size, self.n_envs) + shape[part_key], dtype=dtype[part_key], name=f"{k}.{part_key}"
+                    )
             else:
-                self.buffers[k] = np.zeros((self.buffer_size, self.n_envs) + shape, dtype=dtype)
+                self.buffers[k] = self._zeros((self.buffer_size, self.n_envs) + shape, dtype=dtype, name=k)
         self.ptr, self.path_start_idx, self.max_size = 0, [0]*n_envs, self.buffer_size
-        
-        self.batch_idx = None
-        self.batch_inds = None
-        self.batch_env_inds = None
+
+        # number of times sampling a batch from this buffer compiled a gather, stays constant in steady state training
+        self.compile_count = 0
+        self.sampler = PermutationSampler(np.random.randint(2**31)) if sampler is None else sampler
+        self.random_sampler = RandomSampler(self.sampler.rng)
+
+        self.done_key = done_key
+
+    def _zeros(self, shape, dtype, name):
+        if self.storage == "device":
+            return jnp.zeros(shape, dtype=jax.dtypes.canonicalize_dtype(dtype))
+        if self.storage == "memmap":
+            # the file is created sparse, so disk space is only used as the buffer fills
+            return np.lib.format.open_memmap(osp.join(self.storage_path, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape)
+        return np.zeros(shape, dtype=dtype)
 
     def store(self, **kwargs):
         """
         store one timestep of agent-environment interaction to the buffer. If full, replaces the oldest entry
         """
+        if self.storage == "device":
+            self.buffers.update(_device_store({k: self.buffers[k] for k in kwargs.keys()}, kwargs, self.ptr))
+            self._advance_ptr()
+            return
         for k in kwargs.keys():
             data = kwargs[k]
             if self.is_dict[k]:
@@ -112,63 +213,187 @@ class GenericBuffer(BaseBuffer):
                 d = np.array(data).copy()
                 d = d.reshape(self.buffers[k][self.ptr].shape)
                 self.buffers[k][self.ptr] = d
-        self.ptr += 1
-        if self.ptr == self.buffer_size:
+        self._advance_ptr()
+
+    def store_many(self, **kwargs):
+        """
+        store k timesteps of agent-environment interaction at once. Values have shape (k, n_envs, ...), dict values are
+        dicts of such arrays. If full, replaces the oldest entries, if k > buffer_size only the last buffer_size timesteps
+        are kept
+        """
+        buffers = {k: self.buffers[k] for k in kwargs.keys()}
+        n_steps = np.shape(jax.tree_util.tree_leaves(kwargs)[0])[0]
+
+        def check_shape(buf, data):
+            shape = np.shape(data)
+            assert shape[0] == n_steps and np.prod(shape[1:]) == np.prod(buf.shape[1:]), (
+                f"expected data of shape {(n_steps,) + buf.shape[1:]}, got {shape}"
+            )
+
+        jax.tree_util.tree_map(check_shape, buffers, kwargs)
+        skip = max(n_steps - self.buffer_size, 0)
+        start, n_write = (self.ptr + skip) % self.buffer_size, n_steps - skip
+        if self.storage == "device":
+            data = jax.tree_util.tree_map(lambda d: d[skip:], kwargs)
+            self.buffers.update(_device_store_many(buffers, data, start))
+        else:
+            # at most two slice assignments per buffer, the second one for the part that wraps around
+            n_first = min(n_write, self.buffer_size - start)
+            for buf, data in zip(jax.tree_util.tree_leaves(buffers), jax.tree_util.tree_leaves(kwargs)):
+                data = np.asarray(data)[skip:].reshape((n_write,) + buf.shape[1:])
+                buf[start : start + n_first] = data[:n_first]
+                buf[: n_write - n_first] = data[n_first:]
+        self._advance_ptr(n_steps)
+
+    def _same_episode(self, rows, envs, anchor: int):
+        """
+        which timesteps of each window of (rows, envs) belong to the same episode as the timestep in column anchor. Read
+        from the stored done flags only when sampling, so stores never copy them back from the device
+        """
+        if self.done_key not in self.buffers:
+            return np.ones(rows.shape, dtype=bool)
+        dones = np.asarray(self.buffers[self.done_key][rows, envs], dtype=bool)
+        # episode ends in [anchor, j - 1] after the anchor and in [j, anchor - 1] before it
+        ends_after = np.cumsum(dones[:, anchor:], axis=1) - dones[:, anchor:]
+        ends_before = np.cumsum(dones[:, :anchor][:, ::-1], axis=1)[:, ::-1]
+        return np.concatenate([ends_before == 0, ends_after == 0], axis=1)
+
+    def _advance_ptr(self, n_steps: int = 1):
+        self.ptr += n_steps
+        if self.ptr >= self.buffer_size:
             # wrap pointer around to start replacing items
             self.full = True
-            self.ptr = 0
+            self.ptr %= self.buffer_size
 
 
-    @partial(jax.jit, static_argnames=['self'])
-    def _get_batch_by_ids(self, buffers, batch_ids, env_ids):
+    def _get_batch(self, batch_ids, env_ids):
         """
-        statefully retrieve batch of data
+        gather the (batch_ids, env_ids) entries of every buffer as jax arrays
         """
-        batch_data = dict()
-        for k in buffers.keys():
-            data = buffers[k]
-            if self.is_dict[k]:
-                batch_data[k] = dict()
-                for data_k in data.keys():
-                    batch_data[k][data_k] = jnp.array(data[data_k][batch_ids, env_ids])
-            else:
-                batch_data[k] = jnp.array(data[batch_ids, env_ids])
-        return batch_data
-    def _prepared_for_sampling(self, batch_size, drop_last_batch=True):
-        if self.batch_idx == None: return False
-        if drop_last_batch and self.batch_idx + batch_size > self.buffer_size * self.n_envs: return False
-        if self.batch_idx > self.buffer_size * self.n_envs: return False
-        return True
-
-    # TODO make this jittable.
-    def sample_batch(self, batch_size: int, drop_last_batch=True):
-        """
-        Sample a Batch of data without replacement
-        """
-        if not self._prepared_for_sampling(batch_size, drop_last_batch):
-            self.batch_idx = 0            
-            if self.full:
-                inds = np.arange(0, self.buffer_size).repeat(self.n_envs)
-            else:
-                inds = np.arange(0, self.ptr).repeat(self.n_envs)
-            env_inds = np.tile(np.arange(self.n_envs), len(inds) // self.n_envs)
-            inds = np.vstack([inds, env_inds]).T
-            np.random.shuffle(inds)
-            self.batch_inds = inds[:, 0]
-            self.batch_env_inds = inds[:, 1]
-        batch_ids = self.batch_inds[self.batch_idx: self.batch_idx + batch_size]
-        env_ids = self.batch_env_inds[self.batch_idx: self.batch_idx + batch_size]
-        self.batch_idx = self.batch_idx + batch_size
-        return self._get_batch_by_ids(buffers=self.buffers, batch_ids=batch_ids, env_ids=env_ids)
-            
-    def sample_random_batch(self, batch_size: int):
-        """
-        Sample a batch of data with replacement
+        return self._gather(self.buffers, batch_ids, env_ids)
+
+    def _gather(self, buffers, batch_ids, env_ids):
         """
-        if self.full:
-            batch_ids = (np.random.randint(0, self.buffer_size, size=batch_size) + self.ptr) % self.buffer_size
-        else:
-            batch_ids = np.random.randint(0, self.ptr, size=batch_size)
-        env_ids = np.random.randint(0, high=self.n_envs, size=(len(batch_ids),))
+        gather the (batch_ids, env_ids) entries of a dict of this buffer's buffers as jax arrays
+        """
+        if self.storage == "device":
+            traces = _gather_traces
+            batch = gather_batch(buffers, batch_ids, env_ids)
+            self.compile_count += _gather_traces - traces
+            return batch
+        batch_ids, env_ids = np.asarray(batch_ids), np.asarray(env_ids)
+        if self.storage == "memmap":
+            # read rows in file order so page cache access stays as sequential as possible, then restore the sampled order
+            order = np.argsort(batch_ids * self.n_envs + env_ids, kind="stable")
+            inverse = np.empty_like(order)
+            inverse[order] = np.arange(len(order))
+            rows, envs = batch_ids[order], env_ids[order]
+            return jax.tree_util.tree_map(lambda data: jnp.asarray(data[rows, envs][inverse]), buffers)
+        # gather on the host so only the batch is copied to the device, not the whole buffer
+        return jax.tree_util.tree_map(lambda data: jnp.asarray(data[batch_ids, env_ids]), buffers)
+
+    def flush(self):
+        """
+        write memmap storage to disk
+        """
+        if self.storage == "memmap":
+            jax.tree_util.tree_map(lambda data: data.flush() if isinstance(data, np.memmap) else None, self.buffers)
+
+    def _to_rows(self, t):
+        """
+        map timesteps counted from the oldest stored timestep to rows of the buffer
+        """
+        oldest = self.ptr if self.full else 0
+        return (t + oldest) % self.buffer_size
+
+    def sample_batch(self, batch_size: int, drop_last_batch=True, n_steps: int = None):
+        """
+        Sample a Batch of data with the buffer's sampler, without replacement by default
+
+        If drop_last_batch is False, a partial last batch is padded to batch_size so every batch has the same shape and
+        nothing is recompiled. The batch then also has a boolean "mask" marking the valid entries, losses must ignore the
+        padded ones, as the PPO losses do
+
+        n_steps - only sample from the n_steps oldest stored timesteps, defaults to all of them
+        """
+        n_steps = self.size() if n_steps is None else n_steps
+        t, env_ids = self.sampler.sample(batch_size, n_steps=n_steps, n_envs=self.n_envs, drop_last_batch=drop_last_batch)
+        batch_ids = self._to_rows(t)
+        if drop_last_batch:
+            return self._get_batch(batch_ids, env_ids)
+        batch_ids, env_ids, mask = _pad_to_bucket(batch_ids, env_ids, batch_size)
+        batch = self._get_batch(batch_ids, env_ids)
+        batch["mask"] = jnp.asarray(mask)
+        return batch
+
+    def sample_random_batch(self, batch_size: int, n_steps: int = None):
+        """
+        Sample a batch of data with replacement, from the n_steps oldest stored timesteps if given
+        """
+        n_steps = self.size() if n_steps is None else n_steps
+        t, env_ids = self.random_sampler.sample(batch_size, n_steps=n_steps, n_envs=self.n_envs)
+        return self._get_batch(self._to_rows(t), env_ids)
+
+    def precompute_batch_ids(self, update_iters: int, batch_size: int, n_steps: int = None):
+        """
+        returns the (row, env) indices of update_iters minibatches from the sampler, each of shape (update_iters, batch_size)
+
+        n_steps - only sample from the n_steps oldest stored timesteps, defaults to all of them
+        """
+        n_steps = self.size() if n_steps is None else n_steps
+        t, env_ids = self.sampler.precompute(update_iters, batch_size, n_steps=n_steps, n_envs=self.n_envs)
+        return self._to_rows(t), env_ids
+
+    def sample_sequences(self, batch_size: int, seq_len: int, burn_in: int = 0, state_key: str = None):
+        """
+        Sample batch_size windows of burn_in + seq_len consecutive timesteps for recurrent policies. Windows start burn_in
+        steps before a uniformly sampled timestep and are gathered with one vectorized index.
+
+        Returns a dict with
+
+            batch - the buffers with shape (batch_size, burn_in + seq_len, ...)
+
+            mask - (batch_size, burn_in + seq_len) valid entries, i.e. stored timesteps of the same episode as the sampled
+            timestep. Entries outside of it are padding
+
+            train_mask - mask without the burn in steps, for the loss
+
+            state_ids - (rows, env_ids) of the first valid step of each window, where a recurrent state stored under
+            state_key would be read from
+
+            initial_state - if state_key is given, the state_key data at state_ids
+        """
+        n_steps = self.size()
+        t0, env_ids = self.random_sampler.sample(batch_size, n_steps=n_steps, n_envs=self.n_envs)
+        t = t0[:, None] + np.arange(-burn_in, seq_len)
+        in_range = (t >= 0) & (t < n_steps)
+        rows = self._to_rows(np.clip(t, 0, n_steps - 1))
+        envs = np.broadcast_to(env_ids[:, None], rows.shape)
+        mask = in_range & self._same_episode(rows, envs, burn_in)
+        train_mask = mask.copy()
+        train_mask[:, :burn_in] = False
+
+        batch = self._get_batch(rows.ravel(), envs.ravel())
+        batch = jax.tree_util.tree_map(lambda x: x.reshape(rows.shape + x.shape[1:]), batch)
+        # windows are contiguous, so the first valid step is where the mask first turns on
+        state_rows = rows[np.arange(batch_size), np.argmax(mask, axis=1)]
+        res = dict(batch=batch, mask=jnp.asarray(mask), train_mask=jnp.asarray(train_mask), state_ids=(state_rows, env_ids))
+        if state_key is not None:
+            res["initial_state"] = jax.tree_util.tree_map(lambda x: jnp.asarray(x[state_rows, env_ids]), self.buffers[state_key])
+        return res
+
+    def reset(self) -> None:
+        super().reset()
+        self.sampler.reset()
+
+
+class DeviceBuffer(GenericBuffer):
+    """
+    GenericBuffer whose storage is a pytree of jax arrays on the default device.
+
+    Each store is a jitted dynamic_update_slice with the buffers donated, so data produced by jax (e.g. values and log
+    probs from the policy) never leave the device and sampled batches are gathered on device.
+    """
 
-        return self._get_batch_by_ids(buffers=self.buffers, batch_ids=batch_ids, env_ids=env_ids)
\ No newline at end of file
+    def __init__(self, buffer_size: int, device="cpu", n_envs: int = 1, config=dict(), sampler: Sampler = None):
+        super().__init__(buffer_size=buffer_size, device=device, n_envs=n_envs, config=config, storage="device", sampler=sampler)
@@ -0,0 +1,263 @@
+"""
+Replay storage for frame-stacked pixel observations (e.g. Atari with 4 stacked 84x84 frames).
+
+Consecutive stacked observations of an episode share all but their newest frame, so only the newest frame of every
+observation is stored, as uint8. Stacks are rebuilt at sample time by gathering the previous frames of the same env,
+padding the frames from before the start of an episode like the frame stacking wrapper does (zeros for SB3's
+VecFrameStack, the first frame repeated for gym's FrameStack).
+
+Optionally, chunks of old frames are compressed with zlib or lz4 and decompressed into a small cache when sampled.
+"""
+
+import zlib
+from collections import OrderedDict
+from typing import Tuple
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from walle_rl.buffer.buffer import GenericBuffer
+from walle_rl.buffer.sampler import Sampler
+
+
+def _compress(data: np.ndarray, compression: str) -> bytes:
+    if compression == "lz4":
+        import lz4.frame
+
+        return lz4.frame.compress(data.tobytes())
+    return zlib.compress(data.tobytes(), 1)
+
+
+def _decompress(data: bytes, compression: str, shape, dtype) -> np.ndarray:
+    if compression == "lz4":
+        import lz4.frame
+
+        data = lz4.frame.decompress(data)
+    else:
+        data = zlib.decompress(data)
+    return np.frombuffer(data, dtype=dtype).reshape(shape).copy()
+
+
+class FrameStackStorage:
+    """
+    Stores the newest frame of each (t, env) observation and rebuilds stacks of n_stack frames with vectorized gathers.
+
+    frame_shape - shape of a single frame, i.e. the observation shape without the stack axis
+
+    stack_axis - axis of the observation (without the batch dim) that frames are stacked along
+
+    pad - "zeros" or "repeat", how frames from before the episode start are filled in
+
+    compression - None, "zlib" or "lz4" (needs the lz4 package). Frames are kept in chunks of chunk_size timesteps, the
+    hot_chunks most recently completed chunks and the chunk being written stay uncompressed, older chunks are compressed.
+    Up to cache_chunks decompressed chunks are cached for sampling
+    """
+
+    PAD_TYPES = ["zeros", "repeat"]
+    COMPRESSION_TYPES = [None, "zlib", "lz4"]
+
+    def __init__(
+        self,
+        buffer_size: int,
+        n_envs: int,
+        frame_shape: Tuple,
+        n_stack: int = 4,
+        stack_axis: int = -1,
+        pad: str = "zeros",
+        compression: str = None,
+        chunk_size: int = 1000,
+        hot_chunks: int = 2,
+        cache_chunks: int = 16,
+    ) -> None:
+        assert pad in self.PAD_TYPES, f"pad must be one of {self.PAD_TYPES}, got {pad}"
+        assert compression in self.COMPRESSION_TYPES, f"compression must be one of {self.COMPRESSION_TYPES}, got {compression}"
+        self.buffer_size, self.n_envs = buffer_size, n_envs
+        self.frame_shape = tuple(frame_shape)
+        self.n_stack, self.pad = n_stack, pad
+        # axis of a batch of observations that frames are stacked along
+        self.stack_axis = stack_axis if stack_axis < 0 else stack_axis + 1
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.hot_chunks, self.cache_chunks = hot_chunks, cache_chunks
+        self.episode_start = np.zeros((buffer_size, n_envs), dtype=bool)
+        if compression is None:
+            self.frames = np.zeros((buffer_size, n_envs) + self.frame_shape, dtype=np.uint8)
+        else:
+            n_chunks = -(-buffer_size // chunk_size)
+            # each chunk is a uint8 array while hot and compressed bytes once cold, None before it is first written
+            self.chunks = [None] * n_chunks
+            self.cache = OrderedDict()
+
+    def _chunk_shape(self, chunk: int):
+        rows = min(self.chunk_size, self.buffer_size - chunk * self.chunk_size)
+        return (rows, self.n_envs) + self.frame_shape
+
+    def _hot_chunk(self, chunk: int) -> np.ndarray:
+        data = self.chunks[chunk]
+        if data is None:
+            data = np.zeros(self._chunk_shape(chunk), dtype=np.uint8)
+        elif isinstance(data, bytes):
+            data = _decompress(data, self.compression, self._chunk_shape(chunk), np.uint8)
+        self.chunks[chunk] = data
+        self.cache.pop(chunk, None)
+        return data
+
+    def _chunk_frames(self, chunk: int) -> np.ndarray:
+        data = self.chunks[chunk]
+        if not isinstance(data, bytes):
+            return data
+        if chunk in self.cache:
+            self.cache.move_to_end(chunk)
+            return self.cache[chunk]
+        frames = _decompress(data, self.compression, self._chunk_shape(chunk), np.uint8)
+        self.cache[chunk] = frames
+        if len(self.cache) > self.cache_chunks:
+            self.cache.popitem(last=False)
+        return frames
+
+    def store(self, ptr: int, observations: np.ndarray, episode_start: np.ndarray):
+        """
+        store the newest frame of a (n_envs,) + obs_shape batch of stacked observations at row ptr. episode_start marks the
+        envs whose observation is the first of an episode
+        """
+        frames = np.asarray(observations).take(-1, axis=self.stack_axis)
+        self.episode_start[ptr] = episode_start
+        if self.compression is None:
+            self.frames[ptr] = frames
+            return
+        chunk, row = divmod(ptr, self.chunk_size)
+        self._hot_chunk(chunk)[row] = frames
+        if row == self._chunk_shape(chunk)[0] - 1:
+            cold = chunk - self.hot_chunks
+            if cold < 0:
+                cold += len(self.chunks)
+            if cold != chunk and isinstance(self.chunks[cold], np.ndarray):
+                self.chunks[cold] = _compress(self.chunks[cold], self.compression)
+
+    def _gather_frames(self, rows: np.ndarray, env_ids: np.ndarray) -> np.ndarray:
+        if self.compression is None:
+            return self.frames[rows, env_ids]
+        out = np.zeros((len(rows),) + self.frame_shape, dtype=np.uint8)
+        chunk_ids = rows // self.chunk_size
+        for chunk in np.unique(chunk_ids):
+            if self.chunks[chunk] is None:
+                continue
+            mask = chunk_ids == chunk
+            out[mask] = self._chunk_frames(chunk)[rows[mask] - chunk * self.chunk_size, env_ids[mask]]
+        return out
+
+    def get(self, batch_ids: np.ndarray, env_ids: np.ndarray, oldest: int, stack_first: bool = False) -> np.ndarray:
+        """
+        rebuild the stacked observations at (batch_ids, env_ids). oldest is the row of the oldest stored timestep, frames
+        from before it are treated like frames from before the episode start
+
+        stack_first - if True, frames are returned stacked along axis 1 instead of stack_axis. Moving a small stack axis
+        last is an expensive strided copy in NumPy, callers that move the data to a device can do it there instead
+        """
+        batch_ids, env_ids = np.asarray(batch_ids), np.asarray(env_ids)
+        # timesteps back from batch_ids, oldest frame first
+        back = np.arange(self.n_stack - 1, -1, -1)
+        rows = (batch_ids[:, None] - back) % self.buffer_size
+        # a frame is from the same episode if no episode started after it, up to and including batch_ids
+        starts = self.episode_start[rows[:, 1:], env_ids[:, None]]
+        valid = np.ones(rows.shape, dtype=bool)
+        valid[:, :-1] = ~np.logical_or.accumulate(starts[:, ::-1], axis=1)[:, ::-1]
+        valid &= back <= ((batch_ids - oldest) % self.buffer_size)[:, None]
+        # out of episode frames reuse the first frame of the episode
+        n_back = valid.sum(axis=1) - 1
+        rows = (batch_ids[:, None] - np.minimum(back, n_back[:, None])) % self.buffer_size
+        frames = self._gather_frames(rows.ravel(), np.repeat(env_ids, self.n_stack))
+        frames = frames.reshape(rows.shape + self.frame_shape)
+        if self.pad == "zeros":
+            frames[~valid] = 0
+        if stack_first:
+            return frames
+        return np.ascontiguousarray(np.moveaxis(frames, 1, self.stack_axis))
+
+    def nbytes(self) -> int:
+        """
+        bytes used by the stored frames, not counting the decompression cache
+        """
+        if self.compression is None:
+            return self.frames.nbytes
+        return sum(len(c) if isinstance(c, bytes) else c.nbytes for c in self.chunks if c is not None)
+
+
+class FrameStackBuffer(GenericBuffer):
+    """
+    GenericBuffer that stores the obs_key observations in a FrameStackStorage instead of in full. Other keys are stored as
+    usual and obs_key should not be in config.
+
+    Episode starts are tracked from done_key: the observation stored after a done is the first of a new episode.
+    episode_start can also be passed to store directly.
+    """
+
+    def __init__(
+        self,
+        buffer_size: int,
+        obs_shape: Tuple,
+        device="cpu",
+        n_envs: int = 1,
+        config=dict(),
+        obs_key: str = "obs",
+        done_key: str = "done",
+        n_stack: int = 4,
+        stack_axis: int = -1,
+        pad: str = "zeros",
+        compression: str = None,
+        chunk_size: int = 1000,
+        hot_chunks: int = 2,
+        cache_chunks: int = 16,
+        sampler: Sampler = None,
+    ):
+        super().__init__(
+            buffer_size=buffer_size, device=device, n_envs=n_envs, config=config, sampler=sampler, done_key=done_key
+        )
+        self.obs_key, self.done_key = obs_key, done_key
+        frame_shape = list(obs_shape)
+        assert frame_shape.pop(stack_axis) == n_stack, f"obs_shape {obs_shape} doesn't have {n_stack} frames on axis {stack_axis}"
+        self.frame_storage = FrameStackStorage(
+            buffer_size=self.buffer_size,
+            n_envs=n_envs,
+            frame_shape=frame_shape,
+            n_stack=n_stack,
+            stack_axis=stack_axis,
+            pad=pad,
+            compression=compression,
+            chunk_size=chunk_size,
+            hot_chunks=hot_chunks,
+            cache_chunks=cache_chunks,
+        )
+        self.next_episode_start = np.ones(n_envs, dtype=bool)
+
+    def store(self, episode_start=None, **kwargs):
+        """
+        store one timestep of agent-environment interaction to the buffer. If full, replaces the oldest entry
+        """
+        episode_start = self.next_episode_start if episode_start is None else np.asarray(episode_start, dtype=bool)
+        self.frame_storage.store(self.ptr, kwargs.pop(self.obs_key), episode_start)
+        if self.done_key in kwargs:
+            self.next_episode_start = np.asarray(kwargs[self.done_key], dtype=bool).reshape(self.n_envs)
+        super().store(**kwargs)
+
+    def store_many(self, episode_start=None, **kwargs):
+        """
+        store k timesteps at once, see GenericBuffer.store_many. episode_start, if given, has shape (k, n_envs)
+        """
+        for i in range(len(kwargs[self.obs_key])):
+            self.store(
+                episode_start=None if episode_start is None else episode_start[i],
+                **jax.tree_util.tree_map(lambda d: d[i], kwargs),
+            )
+
+    def _get_batch(self, batch_ids, env_ids):
+        batch = super()._get_batch(batch_ids, env_ids)
+        oldest = self.ptr if self.full else 0
+        frames = jnp.asarray(self.frame_storage.get(batch_ids, env_ids, oldest, stack_first=True))
+        batch[self.obs_key] = jnp.moveaxis(frames, 1, self.frame_storage.stack_axis)
+        return batch
+
+    def reset(self) -> None:
+        super().reset()
+        self.next_episode_start = np.ones(self.n_envs, dtype=bool)
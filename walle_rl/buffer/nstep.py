@@ -0,0 +1,136 @@
+"""
+Replay storage with n-step returns maintained at insert time.
+
+Every stored transition i keeps its discounted return over the next k <= n stored rewards of its episode, the row of
+the k-th transition (whose next observation is the bootstrap observation) and the discount to apply to the bootstrap
+value, gamma ** k or 0 once the episode terminated. Each store only updates the last n rows, for all envs at once, so
+sampling an n-step batch costs the same as sampling a 1-step batch. Transitions stored less than n steps ago hold
+valid k-step targets with k < n. An episode that ends, terminated or truncated, also ends the windows that cover it.
+"""
+
+import numpy as np
+
+from walle_rl.buffer.buffer import GenericBuffer
+from walle_rl.buffer.sampler import Sampler
+
+
+class NStepBuffer(GenericBuffer):
+    """
+    GenericBuffer that also stores, for every transition,
+
+        nstep_ret_buf - sum_{j<k} gamma ** j * r_{i+j}
+
+        nstep_discount_buf - gamma ** k, or 0 if the episode terminated within the k steps
+
+        nstep_last_buf - row of transition i + k - 1
+
+    so the n-step target is nstep_ret_buf + nstep_discount_buf * V(next_obs of nstep_last_buf).
+
+    reward_key, done_key - config keys of the rewards and of the episode termination flags. Truncated episodes should
+    not be marked as done, or they won't be bootstrapped
+
+    trunc_key - optional config key of the episode truncation flags, e.g. from infos[i]["TimeLimit.truncated"]. A
+    truncation stops the returns of the episode from accumulating the rewards of the next, auto reset, episode while
+    still bootstrapping with discount gamma ** k
+
+    next_obs_key - if given (e.g. "next_obs_buf"), sampled batches hold the next observation of nstep_last_buf under
+    this key, i.e. the n-step bootstrap observation, instead of the next observation of the sampled transition. At the
+    last transition of a truncated episode it should hold the terminal observation (infos[i]["terminal_observation"]
+    of auto resetting vectorized envs), not the reset observation
+    """
+
+    def __init__(
+        self,
+        buffer_size: int,
+        device="cpu",
+        n_envs: int = 1,
+        config=dict(),
+        storage: str = "numpy",
+        storage_path: str = None,
+        sampler: Sampler = None,
+        n_step: int = 3,
+        gamma: float = 0.99,
+        reward_key: str = "rew_buf",
+        done_key: str = "done_buf",
+        trunc_key: str = None,
+        next_obs_key: str = None,
+    ):
+        assert storage != "device", "NStepBuffer updates past rows on the host and doesn't support device storage"
+        config = dict(
+            config,
+            nstep_ret_buf=((), np.float32),
+            nstep_discount_buf=((), np.float32),
+            nstep_last_buf=((), np.int64),
+        )
+        super().__init__(
+            buffer_size=buffer_size,
+            device=device,
+            n_envs=n_envs,
+            config=config,
+            storage=storage,
+            storage_path=storage_path,
+            sampler=sampler,
+            done_key=done_key,
+        )
+        self.n_step, self.gamma = n_step, gamma
+        self.reward_key, self.trunc_key, self.next_obs_key = reward_key, trunc_key, next_obs_key
+        # gamma ** j for the reward observed j steps after a transition
+        self.discounts = gamma ** np.arange(n_step + 1)
+        self._reset_open()
+
+    def _reset_open(self):
+        # transitions whose n-step return is still accumulating rewards
+        self.open = np.zeros((self.buffer_size, self.n_envs), dtype=bool)
+
+    def _update_nstep(self, ptr: int, rewards, dones, truncs=None):
+        """
+        add the rewards of the transitions written at row ptr to the n-step returns of the last n rows
+        """
+        rewards = np.asarray(rewards, dtype=np.float32).reshape(self.n_envs)
+        dones = np.asarray(dones, dtype=bool).reshape(self.n_envs)
+        # episodes that ended either way close their windows, only terminations zero the bootstrap discount
+        ends = dones if truncs is None else dones | np.asarray(truncs, dtype=bool).reshape(self.n_envs)
+        age = np.arange(min(self.n_step, self.buffer_size))
+        rows = (ptr - age) % self.buffer_size
+        ret, discount, last = (self.buffers[k] for k in ["nstep_ret_buf", "nstep_discount_buf", "nstep_last_buf"])
+        ret[ptr], self.open[ptr] = 0, True
+
+        active = self.open[rows]
+        ret[rows] += np.where(active, self.discounts[age, None] * rewards, 0)
+        discount[rows] = np.where(active, np.where(dones, 0, self.discounts[age + 1, None]), discount[rows])
+        last[rows] = np.where(active, ptr, last[rows])
+        self.open[rows] = active & ~ends & (age < self.n_step - 1)[:, None]
+
+    def _truncs(self, kwargs):
+        return None if self.trunc_key is None else np.asarray(kwargs[self.trunc_key])
+
+    def store(self, **kwargs):
+        """
+        store one timestep of agent-environment interaction and update the n-step returns of the last n timesteps
+        """
+        self._update_nstep(self.ptr, kwargs[self.reward_key], kwargs[self.done_key], self._truncs(kwargs))
+        super().store(**kwargs)
+
+    def store_many(self, **kwargs):
+        """
+        store k timesteps at once, see GenericBuffer.store_many
+        """
+        rewards, dones = np.asarray(kwargs[self.reward_key]), np.asarray(kwargs[self.done_key])
+        truncs = self._truncs(kwargs)
+        for i in range(len(rewards)):
+            self._update_nstep(
+                (self.ptr + i) % self.buffer_size, rewards[i], dones[i], None if truncs is None else truncs[i]
+            )
+        super().store_many(**kwargs)
+
+    def _get_batch(self, batch_ids, env_ids):
+        if self.next_obs_key is None:
+            return super()._get_batch(batch_ids, env_ids)
+        batch = self._gather({k: v for k, v in self.buffers.items() if k != self.next_obs_key}, batch_ids, env_ids)
+        last = self.buffers["nstep_last_buf"][batch_ids, env_ids]
+        batch.update(self._gather({self.next_obs_key: self.buffers[self.next_obs_key]}, last, env_ids))
+        return batch
+
+    def reset(self) -> None:
+        super().reset()
+        self._reset_open()
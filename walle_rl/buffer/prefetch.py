@@ -0,0 +1,124 @@
+"""
+Background minibatch prefetching so sampling and the host to device copy overlap with the gradient step.
+"""
+
+import queue
+import threading
+from typing import Any, Iterator
+
+import jax
+
+from walle_rl.buffer.buffer import GenericBuffer
+
+_END = object()
+
+
+class PrefetchLoader:
+    """
+    Iterates over n_batches minibatches of a buffer that are sampled and put on device by a background thread, up to
+    prefetch batches ahead of the consumer.
+
+    Works with any GenericBuffer (e.g. PPOBuffer, whose batches are Batch dataclasses). The buffer must not be sampled
+    or modified by another thread while the loader is running.
+
+    Parameters
+    ----------
+    buffer - the buffer to sample from
+
+    batch_size - size of each minibatch
+
+    n_batches - number of minibatches to yield, None to keep sampling until closed
+
+    prefetch - max number of batches prepared ahead, bounds the extra memory used
+
+    random - if True, batches are drawn with replacement via sample_random_batch, otherwise via sample_batch
+
+    n_steps - only sample from the n_steps oldest stored timesteps of the buffer, defaults to all of them
+
+    device - jax device to put batches on, defaults to the default device
+
+    Use as a context manager or call close() to stop the background thread early. Exhausting the iterator also
+    stops it.
+    """
+
+    def __init__(
+        self,
+        buffer: GenericBuffer,
+        batch_size: int,
+        n_batches: int = None,
+        prefetch: int = 2,
+        random: bool = False,
+        drop_last_batch: bool = True,
+        device=None,
+        n_steps: int = None,
+    ) -> None:
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.n_batches = n_batches
+        self.random = random
+        self.drop_last_batch = drop_last_batch
+        self.device = device
+        self.n_steps = n_steps
+        self._queue = queue.Queue(maxsize=max(prefetch, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _sample(self) -> Any:
+        if self.random:
+            batch = self.buffer.sample_random_batch(self.batch_size, n_steps=self.n_steps)
+        else:
+            batch = self.buffer.sample_batch(self.batch_size, drop_last_batch=self.drop_last_batch, n_steps=self.n_steps)
+        return jax.device_put(batch, self.device)
+
+    def _put(self, item) -> bool:
+        # wait for space in the queue, but give up if the loader is closed
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        i = 0
+        try:
+            while self.n_batches is None or i < self.n_batches:
+                if not self._put(self._sample()):
+                    return
+                i += 1
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(_END)
+
+    def __iter__(self) -> Iterator[Any]:
+        while not self._stop.is_set():
+            item = self._queue.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                self.close()
+                raise item
+            yield item
+        self.close()
+
+    def close(self):
+        """
+        stop the background thread and drop any prefetched batches
+        """
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __enter__(self) -> "PrefetchLoader":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,222 @@
+"""
+Prioritized experience replay (https://arxiv.org/abs/1511.05952) on top of GenericBuffer.
+
+Priorities are kept in an array-backed sum-tree: node i has children 2i and 2i + 1 and the leaves start at index
+n_leaves. Batched sampling descends all samples through the tree together and batched updates recompute the changed
+parents level by level, so both are O(batch_size * log N) vectorized operations.
+"""
+
+from functools import partial
+from typing import Tuple
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from chex import Array, PRNGKey
+
+from walle_rl.buffer.buffer import GenericBuffer
+from walle_rl.buffer.sampler import Sampler
+from walle_rl.common.random import PRNGSequence
+
+
+class SumTree:
+    """
+    NumPy sum-tree over capacity leaves
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.depth = max(int(np.ceil(np.log2(capacity))), 0)
+        self.n_leaves = 1 << self.depth
+        self.tree = np.zeros(2 * self.n_leaves, dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        return self.tree[1]
+
+    def get(self, indices: np.ndarray) -> np.ndarray:
+        return self.tree[np.asarray(indices) + self.n_leaves]
+
+    def update(self, indices: np.ndarray, priorities: np.ndarray):
+        """
+        set the priorities of the given leaves. If an index repeats, the last priority is used
+        """
+        idx = np.asarray(indices) + self.n_leaves
+        self.tree[idx] = priorities
+        for _ in range(self.depth):
+            idx = np.unique(idx // 2)
+            self.tree[idx] = self.tree[2 * idx] + self.tree[2 * idx + 1]
+
+    def sample(self, values: np.ndarray) -> np.ndarray:
+        """
+        returns the leaf whose prefix sum interval contains each value in [0, total)
+        """
+        values = np.array(values, dtype=np.float64)
+        idx = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * idx
+            left_sum = self.tree[left]
+            # never descend into an empty subtree, which float error could otherwise cause
+            go_right = (values >= left_sum) & (self.tree[left + 1] > 0)
+            values = np.where(go_right, values - left_sum, values)
+            idx = left + go_right
+        return idx - self.n_leaves
+
+
+def sum_tree_create(capacity: int) -> Array:
+    """
+    jittable sum-tree, represented by its node array
+    """
+    depth = max(int(np.ceil(np.log2(capacity))), 0)
+    return jnp.zeros(2 * (1 << depth), dtype=jnp.float32)
+
+
+@partial(jax.jit, donate_argnums=(0,))
+def sum_tree_update(tree: Array, indices: Array, priorities: Array) -> Array:
+    n_leaves = tree.shape[0] // 2
+    idx = indices + n_leaves
+    tree = tree.at[idx].set(priorities)
+    for _ in range(n_leaves.bit_length() - 1):
+        idx = idx // 2
+        tree = tree.at[idx].set(tree[2 * idx] + tree[2 * idx + 1])
+    return tree
+
+
+@jax.jit
+def sum_tree_sample(tree: Array, values: Array) -> Array:
+    n_leaves = tree.shape[0] // 2
+    idx = jnp.ones(values.shape, dtype=jnp.int32)
+    for _ in range(n_leaves.bit_length() - 1):
+        left = 2 * idx
+        left_sum = tree[left]
+        go_right = (values >= left_sum) & (tree[left + 1] > 0)
+        values = jnp.where(go_right, values - left_sum, values)
+        idx = left + go_right
+    return idx - n_leaves
+
+
+@partial(jax.jit, static_argnames=["batch_size"])
+def prioritized_sample(key: PRNGKey, tree: Array, batch_size: int, size: int, beta: float) -> Tuple[Array, Array]:
+    """
+    stratified sampling of batch_size leaves proportional to their priority. Returns the leaf indices and the importance
+    sampling weights (size * P(i)) ** -beta normalized by the largest weight in the batch
+    """
+    total = tree[1]
+    values = (jnp.arange(batch_size) + jax.random.uniform(key, (batch_size,))) / batch_size * total
+    indices = sum_tree_sample(tree, values)
+    probs = tree[indices + tree.shape[0] // 2] / total
+    weights = (size * probs) ** -beta
+    return indices, weights / weights.max()
+
+
+class PrioritizedBuffer(GenericBuffer):
+    """
+    GenericBuffer with proportional prioritized sampling. Uses the same config / dict layout as GenericBuffer.
+
+    Each (t, env) transition is a leaf of a sum-tree with flat index t * n_envs + env. New transitions get the
+    largest priority seen so far. With storage="device" the sum-tree is a jax array updated and sampled by jitted
+    functions, otherwise it's a NumPy SumTree.
+
+    alpha - how much prioritization is used, 0 is uniform sampling
+
+    beta - default importance sampling exponent, usually annealed towards 1 over training
+
+    eps - added to priorities so no transition has zero probability
+
+    sampler - not supported, prioritized batches are always drawn from the sum-tree. Raises a ValueError if given
+    """
+
+    def __init__(
+        self,
+        buffer_size: int,
+        device="cpu",
+        n_envs: int = 1,
+        config=dict(),
+        storage: str = "numpy",
+        storage_path: str = None,
+        alpha: float = 0.6,
+        beta: float = 0.4,
+        eps: float = 1e-6,
+        seed: int = 0,
+        sampler: Sampler = None,
+    ):
+        if sampler is not None:
+            raise ValueError("PrioritizedBuffer samples from its sum-tree and doesn't take a sampler")
+        super().__init__(
+            buffer_size=buffer_size, device=device, n_envs=n_envs, config=config, storage=storage, storage_path=storage_path
+        )
+        self.alpha, self.beta, self.eps = alpha, beta, eps
+        self.max_priority = 1.0
+        self.capacity = self.buffer_size * self.n_envs
+        self.np_rng = np.random.default_rng(seed)
+        self.rng = PRNGSequence(seed)
+        self._create_tree()
+
+    def _create_tree(self):
+        if self.storage == "device":
+            self.tree = sum_tree_create(self.capacity)
+        else:
+            self.tree = SumTree(self.capacity)
+
+    def _update_tree(self, indices, priorities):
+        if self.storage == "device":
+            self.tree = sum_tree_update(self.tree, jnp.asarray(indices), jnp.asarray(priorities, dtype=jnp.float32))
+        else:
+            self.tree.update(indices, priorities)
+
+    def store(self, **kwargs):
+        """
+        store one timestep of all envs with the max priority seen so far
+        """
+        indices = self.ptr * self.n_envs + np.arange(self.n_envs)
+        super().store(**kwargs)
+        self._update_tree(indices, np.full(self.n_envs, self.max_priority**self.alpha))
+
+    def store_many(self, **kwargs):
+        """
+        store k timesteps of all envs at once with the max priority seen so far, see GenericBuffer.store_many
+        """
+        n_steps = np.shape(jax.tree_util.tree_leaves(kwargs)[0])[0]
+        rows = (self.ptr + np.arange(max(n_steps - self.buffer_size, 0), n_steps)) % self.buffer_size
+        super().store_many(**kwargs)
+        indices = (rows[:, None] * self.n_envs + np.arange(self.n_envs)).ravel()
+        self._update_tree(indices, np.full(len(indices), self.max_priority**self.alpha))
+
+    def sample_prioritized_batch(self, batch_size: int, beta: float = None):
+        """
+        Sample a batch of transitions with probability proportional to priority ** alpha
+
+        returns (batch, weights, indices), where weights are the importance sampling weights and indices are the flat
+        transition indices to pass to update_priorities
+        """
+        beta = self.beta if beta is None else beta
+        size = self.size() * self.n_envs
+        if self.storage == "device":
+            indices, weights = prioritized_sample(next(self.rng), self.tree, batch_size, size, beta)
+        else:
+            total = self.tree.total
+            values = (np.arange(batch_size) + self.np_rng.random(batch_size)) / batch_size * total
+            indices = self.tree.sample(values)
+            probs = self.tree.get(indices) / total
+            weights = (size * probs) ** -beta
+            weights = weights / weights.max()
+        batch_ids, env_ids = indices // self.n_envs, indices % self.n_envs
+        batch = self._get_batch(batch_ids, env_ids)
+        return batch, weights, indices
+
+    def update_priorities(self, indices: Array, priorities: Array):
+        """
+        set new priorities (e.g. absolute TD errors) of previously sampled transitions
+        """
+        if self.storage == "device":
+            priorities = jnp.abs(priorities) + self.eps
+            self.max_priority = max(self.max_priority, float(priorities.max()))
+        else:
+            priorities = np.abs(np.asarray(priorities)) + self.eps
+            self.max_priority = max(self.max_priority, float(priorities.max()))
+        self._update_tree(indices, priorities**self.alpha)
+
+    def reset(self) -> None:
+        super().reset()
+        self.max_priority = 1.0
+        self._create_tree()
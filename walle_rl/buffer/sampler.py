@@ -0,0 +1,159 @@
+"""
+Minibatch index samplers for GenericBuffer.
+
+Samplers work on flat transition indices t * n_envs + env over the n_steps stored timesteps, with t counted from the
+oldest stored timestep, and unravel them into (t, env) index arrays. The buffer maps t to rows of its ring buffer.
+Each sampler draws from its own np.random.Generator.
+
+precompute returns the indices of update_iters minibatches at once as (update_iters, batch_size) arrays, e.g. to
+pass to the jitted PPO.fused_update.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+
+class Sampler:
+    """
+    Base class of minibatch samplers
+
+    seed - seed or np.random.Generator to draw from
+    """
+
+    def __init__(self, seed=None) -> None:
+        self.rng = np.random.default_rng(seed)
+
+    def reset(self):
+        """
+        called when the buffer is reset, discards any state of the current epoch
+        """
+        pass
+
+    def sample(self, batch_size: int, n_steps: int, n_envs: int, drop_last_batch: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        returns the (t, env) indices of one minibatch
+        """
+        raise NotImplementedError()
+
+    def precompute(self, update_iters: int, batch_size: int, n_steps: int, n_envs: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        returns the (t, env) indices of update_iters minibatches, each of shape (update_iters, batch_size)
+        """
+        raise NotImplementedError()
+
+
+class PermutationSampler(Sampler):
+    """
+    Samples without replacement from a permutation of all transitions, drawing a new permutation once it is exhausted
+    """
+
+    def __init__(self, seed=None) -> None:
+        super().__init__(seed)
+        self.perm = None
+        self.cursor = 0
+
+    def reset(self):
+        self.perm = None
+        self.cursor = 0
+
+    def sample(self, batch_size: int, n_steps: int, n_envs: int, drop_last_batch: bool = True):
+        n = n_steps * n_envs
+        end = self.cursor + batch_size if drop_last_batch else self.cursor + 1
+        if self.perm is None or len(self.perm) != n or end > n:
+            self.perm = self.rng.permutation(n)
+            self.cursor = 0
+        flat = self.perm[self.cursor : self.cursor + batch_size]
+        self.cursor += batch_size
+        return np.divmod(flat, n_envs)
+
+    def precompute(self, update_iters: int, batch_size: int, n_steps: int, n_envs: int):
+        n = n_steps * n_envs
+        n_minibatches = n // batch_size
+        assert n_minibatches > 0, f"batch_size {batch_size} is larger than the {n} stored transitions"
+        n_epochs = -(-update_iters // n_minibatches)
+        perms = self.rng.permuted(np.tile(np.arange(n), (n_epochs, 1)), axis=1)
+        flat = perms[:, : n_minibatches * batch_size].reshape(-1, batch_size)[:update_iters]
+        return np.divmod(flat, n_envs)
+
+
+class RandomSampler(Sampler):
+    """
+    Samples transitions uniformly with replacement
+    """
+
+    def sample(self, batch_size: int, n_steps: int, n_envs: int, drop_last_batch: bool = True):
+        return np.divmod(self.rng.integers(0, n_steps * n_envs, size=batch_size), n_envs)
+
+    def precompute(self, update_iters: int, batch_size: int, n_steps: int, n_envs: int):
+        return np.divmod(self.rng.integers(0, n_steps * n_envs, size=(update_iters, batch_size)), n_envs)
+
+
+class ChunkSampler(Sampler):
+    """
+    Samples batch_size // chunk_len chunks of chunk_len consecutive timesteps of a single env, with replacement. Each
+    minibatch is laid out chunk by chunk, so it can be reshaped to (batch_size // chunk_len, chunk_len)
+    """
+
+    def __init__(self, chunk_len: int, seed=None) -> None:
+        super().__init__(seed)
+        self.chunk_len = chunk_len
+
+    def _chunks(self, shape: Tuple, n_steps: int, n_envs: int):
+        assert shape[-1] % self.chunk_len == 0, f"batch_size {shape[-1]} is not a multiple of chunk_len {self.chunk_len}"
+        assert n_steps >= self.chunk_len, f"chunk_len {self.chunk_len} is longer than the {n_steps} stored timesteps"
+        n_chunks = shape[:-1] + (shape[-1] // self.chunk_len,)
+        starts, env_ids = np.divmod(self.rng.integers(0, (n_steps - self.chunk_len + 1) * n_envs, size=n_chunks), n_envs)
+        batch_ids = starts[..., None] + np.arange(self.chunk_len)
+        env_ids = np.broadcast_to(env_ids[..., None], batch_ids.shape)
+        return batch_ids.reshape(shape), env_ids.reshape(shape)
+
+    def sample(self, batch_size: int, n_steps: int, n_envs: int, drop_last_batch: bool = True):
+        return self._chunks((batch_size,), n_steps, n_envs)
+
+    def precompute(self, update_iters: int, batch_size: int, n_steps: int, n_envs: int):
+        return self._chunks((update_iters, batch_size), n_steps, n_envs)
+
+
+class StratifiedSampler(Sampler):
+    """
+    Samples without replacement with every minibatch holding batch_size // n_envs timesteps of each env. Each env has its
+    own permutation of timesteps, all of them are redrawn once exhausted
+    """
+
+    def __init__(self, seed=None) -> None:
+        super().__init__(seed)
+        self.perms = None
+        self.cursor = 0
+
+    def reset(self):
+        self.perms = None
+        self.cursor = 0
+
+    def _per_env(self, batch_size: int, n_steps: int, n_envs: int) -> int:
+        assert batch_size % n_envs == 0, f"batch_size {batch_size} is not a multiple of n_envs {n_envs}"
+        per_env = batch_size // n_envs
+        assert per_env <= n_steps, f"batch_size {batch_size} is larger than the {n_steps * n_envs} stored transitions"
+        return per_env
+
+    def sample(self, batch_size: int, n_steps: int, n_envs: int, drop_last_batch: bool = True):
+        per_env = self._per_env(batch_size, n_steps, n_envs)
+        end = self.cursor + per_env if drop_last_batch else self.cursor + 1
+        if self.perms is None or self.perms.shape != (n_envs, n_steps) or end > n_steps:
+            self.perms = self.rng.permuted(np.tile(np.arange(n_steps), (n_envs, 1)), axis=1)
+            self.cursor = 0
+        batch_ids = self.perms[:, self.cursor : self.cursor + per_env]
+        self.cursor += per_env
+        env_ids = np.broadcast_to(np.arange(n_envs)[:, None], batch_ids.shape)
+        return batch_ids.ravel(), env_ids.ravel()
+
+    def precompute(self, update_iters: int, batch_size: int, n_steps: int, n_envs: int):
+        per_env = self._per_env(batch_size, n_steps, n_envs)
+        n_minibatches = n_steps // per_env
+        n_epochs = -(-update_iters // n_minibatches)
+        perms = self.rng.permuted(np.tile(np.arange(n_steps), (n_epochs, n_envs, 1)), axis=2)
+        # (n_epochs, n_envs, n_minibatches, per_env) -> (n_epochs * n_minibatches, n_envs * per_env)
+        perms = perms[:, :, : n_minibatches * per_env].reshape(n_epochs, n_envs, n_minibatches, per_env)
+        batch_ids = perms.transpose(0, 2, 1, 3).reshape(-1, batch_size)[:update_iters]
+        env_ids = np.broadcast_to(np.repeat(np.arange(n_envs), per_env), batch_ids.shape)
+        return batch_ids, env_ids
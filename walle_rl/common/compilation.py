@@ -0,0 +1,46 @@
+"""
+Helpers to avoid paying for XLA compilation at every launch.
+
+enable_compilation_cache turns on JAX's persistent compilation cache, so executables compiled by one run are loaded
+from disk by the next runs with the same shapes. Cache entries are keyed by the lowered computation rather than the
+python objects, so they survive across processes and across instances of e.g. PPO, whose hash is id based.
+
+aot_compile lowers and compiles a jitted function ahead of time, see PPO.warmup.
+"""
+
+import os.path as osp
+import time
+
+import jax
+from jax.experimental.compilation_cache import compilation_cache
+
+
+def enable_compilation_cache(cache_dir: str, min_compile_time_secs: float = 0.0) -> str:
+    """
+    enable the persistent compilation cache in cache_dir for all following compilations of the process and return its
+    absolute path. Only computations taking at least min_compile_time_secs to compile are written to the cache. JAX
+    never evicts entries, so raise min_compile_time_secs or clear cache_dir when it grows too large
+    """
+    cache_dir = osp.abspath(cache_dir)
+    jax.config.update("jax_compilation_cache_dir", cache_dir)
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", min_compile_time_secs)
+    # jax decides whether to use the cache at the first compilation, which may already have happened
+    compilation_cache.reset_cache()
+    return cache_dir
+
+
+def aot_compile(fn, *args, **kwargs) -> float:
+    """
+    lower and compile the jitted fn for the given arguments and return the seconds it took. Arrays may be given as
+    jax.ShapeDtypeStruct. Later calls of fn with arguments of the same shapes and dtypes reuse the executable
+    """
+    stime = time.perf_counter()
+    fn.lower(*args, **kwargs).compile()
+    return time.perf_counter() - stime
+
+
+def shape_dtype(x, shape=None) -> jax.ShapeDtypeStruct:
+    """
+    the jax.ShapeDtypeStruct that x, e.g. a numpy array, has once passed to a jitted function. shape overrides its shape
+    """
+    return jax.ShapeDtypeStruct(x.shape if shape is None else shape, jax.dtypes.canonicalize_dtype(x.dtype))
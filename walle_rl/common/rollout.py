@@ -1,14 +1,181 @@
 from functools import partial
 import time
-from typing import Any
+from typing import Any, Callable
+from chex import PRNGKey
 import jax
 import gym
 import numpy as np
 import jax.numpy as jnp
 
 from walle_rl.buffer.buffer import BaseBuffer
+from walle_rl.common.stats import EpisodeStats
+from walle_rl.envs.base import JaxEnv
 
 from tqdm import tqdm
+
+
+@partial(jax.jit, static_argnames=["policy", "env", "steps", "n_envs", "value_fn"])
+def _collect_jax(
+    rng_key: PRNGKey,
+    policy_params,
+    policy: Callable,
+    env: JaxEnv,
+    steps: int,
+    n_envs: int,
+    env_state,
+    observations,
+    value_fn: Callable = None,
+    value_params=None,
+):
+    rng_key, reset_key = jax.random.split(rng_key)
+    if env_state is None:
+        env_state, observations = env.vmap_reset(reset_key, n_envs)
+
+    def body_fun(carry, _):
+        key, env_state, observations, ep_stats = carry
+        key, pi_key, env_key = jax.random.split(key, 3)
+        pi_output = policy(pi_key, policy_params, observations)
+        env_state, next_os, rewards, dones, infos = env.vmap_step(env_key, env_state, pi_output["actions"])
+
+        ep_stats, episode = ep_stats.update(rewards, dones)
+        transition = dict(
+            obs_buf=observations,
+            act_buf=pi_output["actions"],
+            rew_buf=rewards,
+            val_buf=pi_output["val"],
+            logp_buf=pi_output["logp_a"],
+            done_buf=dones,
+            trunc_buf=infos["truncated"],
+        )
+        return (key, env_state, next_os, ep_stats), (transition, episode, infos["terminal_observation"])
+
+    init = (rng_key, env_state, observations, EpisodeStats.create(n_envs))
+    (_, env_state, observations, _), (buffers, episodes, terminal_obs) = jax.lax.scan(body_fun, init, None, length=steps)
+    if value_fn is not None:
+        # values of the terminal observations of all steps in one batched call, kept where an episode was truncated
+        terminal_obs = jax.tree_util.tree_map(lambda x: x.reshape((-1,) + x.shape[2:]), terminal_obs)
+        terminal_vals = value_fn(value_params, terminal_obs).reshape(steps, n_envs)
+        buffers["boot_val_buf"] = jnp.where(buffers["trunc_buf"], terminal_vals, 0.0)
+    return dict(buffers=buffers, env_state=env_state, observations=observations, **episodes)
+
+
+@partial(jax.jit, static_argnames=["policy", "env", "steps", "n_envs", "value_fn"])
+def _collect_jax_population(
+    rng_key: PRNGKey,
+    policy_params,
+    policy: Callable,
+    env: JaxEnv,
+    steps: int,
+    n_envs: int,
+    value_fn: Callable = None,
+    value_params=None,
+):
+    """
+    _collect_jax vmapped over the leading member axis of policy_params and value_params, each member rolls out its own
+    n_envs envs. Transitions and episode stats are returned as (steps, n_members * n_envs, ...) with contiguous blocks
+    of envs per member, env_state and observations keep the leading member axis
+    """
+    n_members = len(jax.tree_util.tree_leaves(policy_params)[0])
+
+    def collect(key, member_policy_params, member_value_params):
+        return _collect_jax(
+            key, member_policy_params, policy, env, steps, n_envs, None, None, value_fn, member_value_params
+        )
+
+    res = jax.vmap(collect)(jax.random.split(rng_key, n_members), policy_params, value_params)
+
+    def merge(x):
+        # (n_members, steps, n_envs, ...) -> (steps, n_members * n_envs, ...)
+        return jnp.moveaxis(x, 0, 1).reshape((steps, n_members * n_envs) + x.shape[3:])
+
+    return {k: v if k in ["env_state", "observations"] else jax.tree_util.tree_map(merge, v) for k, v in res.items()}
+
+
+def _concat(groups):
+    """
+    concatenate the per group outputs (arrays, or dicts / tuples of arrays) along the env axis
+    """
+
+    def concat(*xs):
+        if isinstance(xs[0], jax.Array):
+            return jnp.concatenate(xs)
+        return np.concatenate(xs)
+
+    return jax.tree_util.tree_map(concat, *groups)
+
+
+class TrajectoryStorage:
+    """
+    Preallocated storage for the ongoing trajectory of each env.
+
+    Each key is stored in one (n_envs, max_ep_len + 1, ...) array written with a single vectorized assignment per step.
+    Finished trajectories are returned as zero-copy slices, which stay valid until that env starts writing its next
+    trajectory. The storage doubles in size if an episode runs longer than max_ep_len.
+    """
+
+    def __init__(self, n_envs: int, max_ep_len: int = 1000) -> None:
+        self.n_envs = n_envs
+        self.capacity = max_ep_len + 1  # one extra slot for the terminal observation
+        self.lengths = np.zeros(n_envs, dtype=int)
+        self.buffers = None
+        self.infos = [[] for _ in range(n_envs)]
+
+    def _allocate(self, x: np.ndarray):
+        return np.zeros((self.n_envs, self.capacity) + x.shape[1:], dtype=x.dtype)
+
+    def _grow(self):
+        self.capacity *= 2
+
+        def grow(buf):
+            new_buf = np.zeros((self.n_envs, self.capacity) + buf.shape[2:], dtype=buf.dtype)
+            new_buf[:, : buf.shape[1]] = buf
+            return new_buf
+
+        self.buffers = jax.tree_util.tree_map(grow, self.buffers)
+
+    def add(self, observations, actions, rewards, infos):
+        """
+        add one step of data of all envs
+        """
+        data = dict(
+            observations=jax.tree_util.tree_map(np.asarray, observations),
+            actions=np.asarray(actions).reshape(self.n_envs, -1),
+            rewards=np.asarray(rewards).reshape(self.n_envs, 1),
+        )
+        if self.buffers is None:
+            self.buffers = jax.tree_util.tree_map(self._allocate, data)
+        if self.lengths.max() + 1 >= self.capacity:
+            self._grow()
+        env_ids = np.arange(self.n_envs)
+
+        def write(buf, x):
+            buf[env_ids, self.lengths] = x
+
+        jax.tree_util.tree_map(write, self.buffers, data)
+        for idx in range(self.n_envs):
+            self.infos[idx].append(infos[idx])
+        self.lengths += 1
+
+    def finish(self, env_id: int, terminal_observation):
+        """
+        end the trajectory of env env_id. Returns views of its observations including terminal_observation, actions,
+        rewards and the list of infos
+        """
+        ep_len = self.lengths[env_id]
+
+        def write(buf, x):
+            buf[env_id, ep_len] = x
+
+        jax.tree_util.tree_map(write, self.buffers["observations"], terminal_observation)
+        t_obs = jax.tree_util.tree_map(lambda buf: buf[env_id, : ep_len + 1], self.buffers["observations"])
+        t_act = self.buffers["actions"][env_id, :ep_len]
+        t_rew = self.buffers["rewards"][env_id, :ep_len]
+        t_info = self.infos[env_id]
+        self.lengths[env_id] = 0
+        self.infos[env_id] = []
+        return t_obs, t_act, t_rew, t_info
+
+
 class Rollout:
     def __init__(self) -> None:
         pass
@@ -25,50 +192,125 @@ class Rollout:
         render=False,
         video_capture=None,
         pbar=False,
-        even_num_traj_per_env=False # collects even number of trajectories per env
+        even_num_traj_per_env=False, # collects even number of trajectories per env
+        max_ep_len=1000,
     ):
         """
         format_trajectory: function
             given trajectories observations, actions, rewards, and past infos, return the desired data to be stored for this trajectory
             default will store observations including the terminal observation, actions, and rewards.
-        
+
+        max_ep_len: int
+            initial size of the preallocated per env storage, it is grown if an episode runs longer
+
+        Dict observations of a trajectory are returned as a list with the dict of each step, as before. Returned
+        trajectories own their data. Use iter_trajectories to stream trajectories without holding them all in memory
         """
         traj_count = 0
         if even_num_traj_per_env:
             assert n_trajectories % n_envs == 0
             max_trajectories_per_env = n_trajectories / n_envs
-            trajectories_per_env = []
+            trajectories_per_env = [[] for _ in range(n_envs)]
         trajectories = []
-        past_obs = []
-        past_rews = []
-        past_acts = []
-        past_infos = []
-        for _ in range(n_envs):
-            past_obs.append([])
-            past_rews.append([])
-            past_acts.append([])
-            past_infos.append([])
-            if even_num_traj_per_env:
-                trajectories_per_env.append([])
-        observations = env.reset()
-        is_dict = isinstance(observations, dict)
-        step = 0
         if pbar:
             pbar = tqdm(total=n_trajectories)
+        for idx, t_obs, t_act, t_rew, t_info in self._iter_trajectories(
+            policy=policy,
+            env=env,
+            n_envs=n_envs,
+            max_ep_len=max_ep_len,
+            rollout_callback=rollout_callback,
+            custom_reward=custom_reward,
+            render=render,
+            video_capture=video_capture,
+        ):
+            if even_num_traj_per_env and len(trajectories_per_env[idx]) >= max_trajectories_per_env:
+                continue
+            # the yielded arrays are views into storage that is reused, so copy the ones we keep
+            t_obs, t_act, t_rew = jax.tree_util.tree_map(np.copy, (t_obs, t_act, t_rew))
+            if isinstance(t_obs, dict):
+                t_obs = [{k: v[i] for k, v in t_obs.items()} for i in range(len(t_act) + 1)]
+            traj = self._format_trajectory(t_obs, t_act, t_rew, t_info, format_trajectory)
+            traj_count += 1
+            if not even_num_traj_per_env:
+                trajectories.append(traj)
+            else:
+                trajectories_per_env[idx].append(traj)
+            if pbar: pbar.update()
+            if traj_count == n_trajectories:
+                if even_num_traj_per_env: return trajectories_per_env
+                else: return trajectories
+
+    def iter_trajectories(
+        self,
+        policy,
+        env: gym.Env,
+        n_envs,
+        n_trajectories=None,
+        rollout_callback=None,
+        format_trajectory=None,
+        custom_reward=None,
+        render=False,
+        video_capture=None,
+        max_ep_len=1000,
+        copy=False,
+    ):
+        """
+        Streaming version of collect_trajectories. Yields each trajectory as soon as it finishes, stops after
+        n_trajectories or never if it is None. Unlike collect_trajectories, dict observations are yielded as a dict of
+        arrays stacked over the steps of the trajectory, the format TrajectoryWriter stores.
+
+        copy: bool
+            if False, the yielded arrays are zero-copy slices of the preallocated rollout storage and are overwritten
+            once the generator is resumed. Consume them right away (e.g. write them to disk) or set copy=True to keep them
+        """
+        traj_count = 0
+        for _, t_obs, t_act, t_rew, t_info in self._iter_trajectories(
+            policy=policy,
+            env=env,
+            n_envs=n_envs,
+            max_ep_len=max_ep_len,
+            rollout_callback=rollout_callback,
+            custom_reward=custom_reward,
+            render=render,
+            video_capture=video_capture,
+        ):
+            if copy:
+                t_obs, t_act, t_rew = jax.tree_util.tree_map(np.copy, (t_obs, t_act, t_rew))
+            yield self._format_trajectory(t_obs, t_act, t_rew, t_info, format_trajectory)
+            traj_count += 1
+            if n_trajectories is not None and traj_count == n_trajectories:
+                return
+
+    def _format_trajectory(self, t_obs, t_act, t_rew, t_info, format_trajectory=None):
+        if format_trajectory is None:
+            return {
+                "observations": t_obs,
+                "rewards": t_rew,
+                "actions": t_act
+            }
+        return format_trajectory(t_obs, t_act, t_rew, t_info)
+
+    def _iter_trajectories(
+        self,
+        policy,
+        env: gym.Env,
+        n_envs,
+        max_ep_len=1000,
+        rollout_callback=None,
+        custom_reward=None,
+        render=False,
+        video_capture=None,
+    ):
+        """
+        endlessly steps env and yields (env_id, observations, actions, rewards, infos) of every finished trajectory as
+        views into a TrajectoryStorage
+        """
+        storage = TrajectoryStorage(n_envs=n_envs, max_ep_len=max_ep_len)
+        observations = env.reset()
+        step = 0
         while True:
             acts = policy(observations)
-
-            if is_dict:
-                for idx in range(n_envs):
-                    o = {}
-                    for k in observations.keys():
-                        o[k] = observations[k][idx]
-                    past_obs[idx].append(o)
-            else:
-                for idx, o in enumerate(observations):
-                    past_obs[idx].append(o)
-            for idx, a in enumerate(acts):
-                past_acts[idx].append(a)
             if render:
                 if render == True:
                     render_o = env.render()
@@ -78,9 +320,7 @@ class Rollout:
                     video_capture(output=render_o, step=step)
             next_os, rewards, dones, infos = env.step(acts)
             if custom_reward is not None: rewards = custom_reward(rewards, observations, acts)
-            for idx in range(len(rewards)):
-                past_rews[idx].append(rewards[idx])
-                past_infos[idx].append(infos[idx])
+            storage.add(observations=observations, actions=acts, rewards=rewards, infos=infos)
             if rollout_callback is not None:
                 rollout_callback(
                     env=env,
@@ -93,50 +333,75 @@ class Rollout:
                 )
 
             observations = next_os
-            # eval_env.render()
-            for idx, d in enumerate(dones):
-                if d:
-                    if not even_num_traj_per_env or len(trajectories_per_env[idx]) < max_trajectories_per_env:
-                        termminal_obs = infos[idx]["terminal_observation"]
-                        past_obs[idx].append(termminal_obs)
-                        t_obs = past_obs[idx] if is_dict else np.vstack(past_obs[idx])
-                        t_act = np.vstack(past_acts[idx])
-                        t_rew = np.vstack(past_rews[idx])
-                        t_info = past_infos[idx]
-                        if format_trajectory is None:
-                            traj = {
-                                "observations": t_obs,
-                                "rewards": t_rew,
-                                "actions": t_act
-                            }
-                        else: 
-                            traj = format_trajectory(t_obs, t_act, t_rew, t_info)
-                        traj_count += 1
-                        if not even_num_traj_per_env:
-                            trajectories.append(traj)
-                        else:
-                            trajectories_per_env[idx].append(traj)
-                        if pbar: pbar.update()
-                    past_obs[idx] = []
-                    past_acts[idx] = []
-                    past_rews[idx] = []
-                    past_infos[idx] = []
-                    if traj_count == n_trajectories:
-                        if even_num_traj_per_env: return trajectories_per_env
-                        else: return trajectories
+            for idx in np.where(dones)[0]:
+                yield (idx,) + storage.finish(idx, terminal_observation=infos[idx]["terminal_observation"])
             step += 1
-    @partial(jax.jit, static_argnums=(0,))
+
     def collect_jax(
         self,
+        rng_key: PRNGKey,
         policy_params,
-        policy,
-        env: Any # TODO - when where there be a "universal" gym definition in jax? There's gymnax and brax that have good defs
+        policy: Callable,
+        env: JaxEnv,
+        steps: int,
+        n_envs: int,
+        env_state=None,
+        observations=None,
+        value_fn: Callable = None,
+        value_params=None,
+        population: bool = False,
     ):
         """
         rollsout in the jax way. Completely jittable.
-        """
-        raise NotImplementedError()
 
+        All steps * n_envs transitions are collected by a single lax.scan, so there are no python round trips or
+        device to host copies per environment step.
+
+        policy: function
+            pure function (key, policy_params, obs) -> dict(actions, val, logp_a), e.g. ActorCritic.policy_fn
+        env: JaxEnv
+            functional environment, n_envs copies of it are stepped with vmap and reset automatically when done
+        env_state, observations:
+            state to continue the rollout from. If None, the environments are reset first
+        value_fn, value_params:
+            optional pure value function (value_params, obs) -> values, e.g. ActorCritic.value_fn. If given, the terminal
+            observations of truncated episodes are evaluated after the rollout and returned as buffers["boot_val_buf"]
+        population:
+            if True, policy_params and value_params are stacked along a leading member axis (see PopulationActorCritic)
+            and every member rolls out its own n_envs envs in one vmapped program. Transitions are then returned as
+            (steps, n_members * n_envs, ...), member i owning envs [i * n_envs, (i + 1) * n_envs). Always starts from
+            reset environments
+
+        returns a dict with
+            buffers - transitions of shape (steps, n_envs, ...) keyed like the PPOBuffer buffers
+            env_state, observations - state of the environments after the last step, to continue rolling out from
+            EpRet, EpLen - (steps, n_envs) return and length of the episodes that finished at each step. Only valid
+            where buffers["done_buf"] is True
+        """
+        if population:
+            assert env_state is None, "population rollouts always start from reset environments"
+            return _collect_jax_population(
+                rng_key=rng_key,
+                policy_params=policy_params,
+                policy=policy,
+                env=env,
+                steps=steps,
+                n_envs=n_envs,
+                value_fn=value_fn,
+                value_params=value_params,
+            )
+        return _collect_jax(
+            rng_key=rng_key,
+            policy_params=policy_params,
+            policy=policy,
+            env=env,
+            steps=steps,
+            n_envs=n_envs,
+            env_state=env_state,
+            observations=observations,
+            value_fn=value_fn,
+            value_params=value_params,
+        )
 
     def collect(
         self,
@@ -149,9 +414,14 @@ class Rollout:
         custom_reward=None,
         logger=None,
         verbose=1,
+        env_tags=None,
     ):
         """
         rollsout in the python way. Not jittable.
+
+        env_tags: list of str
+            optional logger tag of each env. EpRet / EpLen are then also logged under the tag of the env, e.g. to keep the
+            results of population members separable
         """
         # policy should return a, v, logp
         observations, ep_returns, ep_lengths = env.reset(), np.zeros(n_envs), np.zeros(n_envs, dtype=int)
@@ -181,17 +451,113 @@ class Rollout:
                 )
 
             observations = next_os
-            for idx, terminal in enumerate(terminals):
-                if terminal or epoch_ended:
-                    ep_ret = ep_returns[idx]
-                    ep_len = ep_lengths[idx]
-                    if epoch_ended and not terminal and verbose == 1:
-                        print("Warning: trajectory cut off by epoch at %d steps." % ep_lengths[idx], flush=True)
-                    if terminal:
-                        # only save EpRet / EpLen if trajectory finished
-                        if logger is not None: logger.store("train", EpRet=ep_ret, EpLen=ep_len)
-                    ep_returns[idx] = 0
-                    ep_lengths[idx] = 0
+            self._finish_episodes(
+                terminals, epoch_ended, ep_returns, ep_lengths, logger=logger, verbose=verbose, env_tags=env_tags
+            )
         rollout_end_time = time.time_ns()
         rollout_delta_time = (rollout_end_time - rollout_start_time) * 1e-9
         if logger is not None: logger.store("train", rollout_time=rollout_delta_time, append=False)
+
+    def collect_async(
+        self,
+        policy,
+        envs,
+        steps,
+        rollout_callback=None,
+        max_ep_len=1000,
+        custom_reward=None,
+        logger=None,
+        verbose=1,
+        env_tags=None,
+    ):
+        """
+        rollsout with two groups of environments that are stepped asynchronously (EnvPool style double buffering).
+
+        envs: two vectorized envs with the SB3 step_async / step_wait API, e.g. two SharedMemoryVecEnvs. The first env
+            holds env ids [0, n_a) and the second [n_a, n_a + n_b), matching the env axis of the buffer.
+
+        While group A steps in its worker processes, the policy runs on group B's observations and vice versa. Actions
+        are always computed from the latest observations of their group, group A just runs at most one step ahead of
+        group B. rollout_callback is called once per timestep with the data of both groups concatenated, so buffer
+        writes land in the same (t, env) slots as with collect.
+
+        Logs the total inference time and time spent waiting on env workers of each group. env_tags is as in collect.
+        """
+        assert len(envs) == 2, "collect_async expects two groups of environments"
+        n_envs = sum(env.num_envs for env in envs)
+        observations = [env.reset() for env in envs]
+        ep_returns, ep_lengths = np.zeros(n_envs), np.zeros(n_envs, dtype=int)
+        inference_time, env_wait_time = [0, 0], [0, 0]
+
+        def act(g):
+            stime = time.time_ns()
+            pi_output = policy(observations[g])
+            envs[g].step_async(pi_output["actions"])
+            inference_time[g] += time.time_ns() - stime
+            return observations[g], pi_output
+
+        def wait(g):
+            stime = time.time_ns()
+            res = envs[g].step_wait()
+            env_wait_time[g] += time.time_ns() - stime
+            observations[g] = res[0]
+            return res
+
+        rollout_start_time = time.time_ns()
+        in_flight = [act(0), None]
+        for t in range(steps):
+            in_flight[1] = act(1)  # group B inference overlaps with group A stepping
+            results = [wait(0), None]
+            next_in_flight = act(0) if t < steps - 1 else None  # group A inference overlaps with group B stepping
+            results[1] = wait(1)
+
+            obs_t = _concat([in_flight[0][0], in_flight[1][0]])
+            pi_output = _concat([in_flight[0][1], in_flight[1][1]])
+            next_os, rewards, dones, infos = _concat([results[0][:3], results[1][:3]]) + (results[0][3] + results[1][3],)
+            a = pi_output["actions"]
+            if custom_reward is not None: rewards = custom_reward(rewards, obs_t, a)
+
+            ep_returns += rewards
+            ep_lengths += 1
+            timeouts = ep_lengths == max_ep_len
+            terminals = dones | timeouts  # terminated means done or reached max ep length
+            epoch_ended = t == steps - 1
+            if rollout_callback is not None:
+                rollout_callback(
+                    observations=obs_t,
+                    next_observations=next_os,
+                    pi_output=pi_output,
+                    actions=a,
+                    rewards=rewards,
+                    infos=infos,
+                    dones=dones,
+                    timeouts=timeouts,
+                )
+            self._finish_episodes(
+                terminals, epoch_ended, ep_returns, ep_lengths, logger=logger, verbose=verbose, env_tags=env_tags
+            )
+            in_flight[0] = next_in_flight
+        rollout_end_time = time.time_ns()
+        rollout_delta_time = (rollout_end_time - rollout_start_time) * 1e-9
+        if logger is not None:
+            logger.store("train", rollout_time=rollout_delta_time, append=False)
+            for g in range(2):
+                logger.store("train", **{f"inference_time_group{g}": inference_time[g] * 1e-9}, append=False)
+                logger.store("train", **{f"env_wait_time_group{g}": env_wait_time[g] * 1e-9}, append=False)
+
+    def _finish_episodes(self, terminals, epoch_ended, ep_returns, ep_lengths, logger=None, verbose=1, env_tags=None):
+        """
+        log and reset the episode returns and lengths of environments whose episode terminated or got cut off
+        """
+        if epoch_ended and verbose == 1:
+            for ep_len in ep_lengths[~terminals]:
+                print("Warning: trajectory cut off by epoch at %d steps." % ep_len, flush=True)
+        if logger is not None and terminals.any():
+            # only save EpRet / EpLen if trajectory finished
+            logger.extend("train", EpRet=ep_returns[terminals], EpLen=ep_lengths[terminals])
+            if env_tags is not None:
+                for idx in np.flatnonzero(terminals):
+                    logger.store(env_tags[idx], EpRet=ep_returns[idx], EpLen=ep_lengths[idx])
+        ended = terminals | epoch_ended
+        ep_returns[ended] = 0
+        ep_lengths[ended] = 0
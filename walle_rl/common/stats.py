@@ -1,6 +1,11 @@
+from typing import Dict, Tuple
 from chex import Array
 import distrax
+import jax.numpy as jnp
 import scipy.signal
+from flax import struct
+
+
 def discount_cumsum(x, discount):
     """
     magic from rllab for computing discounted cumulative sums of vectors.
@@ -20,4 +25,33 @@ def discount_cumsum(x, discount):
     return scipy.signal.lfilter([1], [1, float(-discount)], x[::-1], axis=0)[::-1]
 
 def _log_prob_from_distribution(dist: distrax.Distribution, x: Array):
-    return dist.log_prob(x)
\ No newline at end of file
+    return dist.log_prob(x)
+
+
+@struct.dataclass
+class EpisodeStats:
+    """
+    Functional accumulator of the running return and length of the current episode of each env.
+
+    Jittable, so it can be carried through a lax.scan rollout and stay on device.
+    """
+
+    returns: Array
+    lengths: Array
+
+    @classmethod
+    def create(cls, n_envs: int) -> "EpisodeStats":
+        return cls(returns=jnp.zeros(n_envs), lengths=jnp.zeros(n_envs, dtype=jnp.int32))
+
+    def update(self, rewards: Array, terminals: Array) -> Tuple["EpisodeStats", Dict[str, Array]]:
+        """
+        add one step of rewards and reset the envs whose episode ended
+
+        returns the new stats and dict(EpRet, EpLen) with the return and length of every env's episode up to and
+        including this step. These are the stats of finished episodes where terminals is True
+        """
+        returns = self.returns + rewards
+        lengths = self.lengths + 1
+        episodes = dict(EpRet=returns, EpLen=lengths)
+        new_stats = self.replace(returns=jnp.where(terminals, 0.0, returns), lengths=jnp.where(terminals, 0, lengths))
+        return new_stats, episodes
@@ -0,0 +1 @@
+from .trajectory import TrajectoryDataset, TrajectoryWriter
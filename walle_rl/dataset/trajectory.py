@@ -0,0 +1,230 @@
+"""
+Sharded on-disk storage of trajectories, e.g. demonstrations for DAPG / GAIL that don't fit in memory.
+
+Layout of a dataset directory:
+
+    index.json              keys with their dtype / shape, shard sizes and the row offsets of every episode
+    <key>.<shard>.npy       rows of key for all episodes in that shard. Nested dict keys like observations/state are
+                            stored as observations.state.<shard>.npy
+
+Episodes never span shards. Each key is stored as its own .npy file so the reader can memory-map it.
+"""
+
+import json
+import os
+import os.path as osp
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+
+
+def _flatten(traj: Dict, prefix: str = "") -> Dict[str, np.ndarray]:
+    flat = dict()
+    for k, v in traj.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix=f"{prefix}{k}/"))
+        else:
+            flat[f"{prefix}{k}"] = np.asarray(v)
+    return flat
+
+
+def _unflatten(flat: Dict[str, np.ndarray]) -> Dict:
+    traj = dict()
+    for k, v in flat.items():
+        parts = k.split("/")
+        d = traj
+        for part in parts[:-1]:
+            d = d.setdefault(part, dict())
+        d[parts[-1]] = v
+    return traj
+
+
+def _shard_file(path: str, key: str, shard: int) -> str:
+    return osp.join(path, f"{key.replace('/', '.')}.{shard:05d}.npy")
+
+
+def _remove_dataset(path: str):
+    """
+    delete the index and all shard files of the dataset at path, including ones that no index refers to
+    """
+    for f in Path(path).iterdir():
+        if f.name in (INDEX_FILE, INDEX_FILE + ".tmp") or re.fullmatch(r".+\.\d{5,}\.npy", f.name):
+            f.unlink()
+
+
+class TrajectoryWriter:
+    """
+    Streams trajectories to disk in shards of roughly shard_size transitions. Only the current shard is held in memory.
+
+    Trajectories are dicts of arrays (nested dicts are allowed, e.g. dict observations) whose first dimension is time,
+    like the ones returned by Rollout.iter_trajectories. The number of transitions of a trajectory is the length of
+    length_key, other keys may have a different number of rows (e.g. observations including the terminal observation)
+
+    Use as a context manager or call close() to flush the last shard.
+
+    overwrite - if True, an existing dataset at path is deleted first. Otherwise a FileExistsError is raised
+    """
+
+    def __init__(self, path: str, shard_size: int = 100_000, length_key: str = "actions", overwrite: bool = False) -> None:
+        self.path = path
+        self.shard_size = shard_size
+        self.length_key = length_key
+        if osp.exists(osp.join(path, INDEX_FILE)) and not overwrite:
+            raise FileExistsError(f"A trajectory dataset already exists at {path}")
+        Path(path).mkdir(parents=True, exist_ok=True)
+        if overwrite:
+            # shards of an earlier, larger dataset would otherwise be left next to the new index
+            _remove_dataset(path)
+
+        self.keys: Dict[str, Dict] = None
+        self.shards: List[Dict] = []
+        self.episodes = dict(shard=[], length=[], offsets=dict())
+
+        self._shard_data: Dict[str, List[np.ndarray]] = None
+        self._shard_rows: Dict[str, int] = None
+        self._shard_transitions = 0
+        self._new_shard()
+
+    def _new_shard(self):
+        self._shard_data = dict() if self.keys is None else {k: [] for k in self.keys}
+        self._shard_rows = dict() if self.keys is None else {k: 0 for k in self.keys}
+        self._shard_transitions = 0
+
+    def write(self, trajectory: Dict):
+        """
+        append one trajectory. The data is copied, so zero-copy views (e.g. from iter_trajectories) are safe to pass in
+        """
+        flat = _flatten(trajectory)
+        if self.keys is None:
+            self.keys = {k: dict(dtype=v.dtype.str, shape=list(v.shape[1:])) for k, v in flat.items()}
+            self.episodes["offsets"] = {k: [] for k in self.keys}
+            self._new_shard()
+        assert flat.keys() == self.keys.keys(), f"trajectory keys {list(flat.keys())} don't match {list(self.keys.keys())}"
+
+        length = len(flat[self.length_key])
+        if self._shard_transitions > 0 and self._shard_transitions + length > self.shard_size:
+            self._flush()
+        shard = len(self.shards)
+        for k, v in flat.items():
+            start = self._shard_rows[k]
+            self._shard_data[k].append(np.array(v, dtype=self.keys[k]["dtype"]))
+            self._shard_rows[k] += len(v)
+            self.episodes["offsets"][k].append([start, start + len(v)])
+        self.episodes["shard"].append(shard)
+        self.episodes["length"].append(length)
+        self._shard_transitions += length
+        if self._shard_transitions >= self.shard_size:
+            self._flush()
+
+    def _flush(self):
+        if self._shard_transitions == 0:
+            return
+        shard = len(self.shards)
+        for k, parts in self._shard_data.items():
+            np.save(_shard_file(self.path, k, shard), np.concatenate(parts, axis=0))
+        self.shards.append(dict(transitions=self._shard_transitions, rows=dict(self._shard_rows)))
+        self._new_shard()
+        self._write_index()
+
+    def _write_index(self):
+        index = dict(length_key=self.length_key, keys=self.keys, shards=self.shards, episodes=self.episodes)
+        tmp_file = osp.join(self.path, INDEX_FILE + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_file, osp.join(self.path, INDEX_FILE))
+
+    def close(self):
+        if self._shard_transitions > 0:
+            # also writes the index
+            self._flush()
+        elif not self.shards:
+            # nothing was written, still leave the index of an empty dataset
+            self._write_index()
+
+    def __enter__(self) -> "TrajectoryWriter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TrajectoryDataset:
+    """
+    Reads a dataset written by TrajectoryWriter. Shards are memory-mapped on first access, so only the rows that are
+    indexed are read from disk.
+
+    dataset[i] returns episode i as a dict of read-only memory-mapped arrays. sample returns random transitions
+    gathered across all shards.
+    """
+
+    def __init__(self, path: str, seed: Optional[int] = None) -> None:
+        self.path = path
+        with open(osp.join(path, INDEX_FILE), "r") as f:
+            index = json.load(f)
+        self.length_key = index["length_key"]
+        self.keys = index["keys"]
+        self.shards = index["shards"]
+        self.episode_shard = np.array(index["episodes"]["shard"], dtype=int)
+        self.episode_length = np.array(index["episodes"]["length"], dtype=int)
+        self.episode_offsets = {k: np.array(v, dtype=int).reshape(-1, 2) for k, v in index["episodes"]["offsets"].items()}
+        # first transition id of each episode, for mapping sampled transitions back to episodes
+        self.episode_start = np.concatenate([[0], np.cumsum(self.episode_length)])
+        self.rng = np.random.default_rng(seed)
+        self._mmaps: Dict = dict()
+
+    def __len__(self) -> int:
+        return len(self.episode_length)
+
+    @property
+    def n_transitions(self) -> int:
+        return int(self.episode_start[-1])
+
+    def _get_mmap(self, key: str, shard: int) -> np.ndarray:
+        if (key, shard) not in self._mmaps:
+            self._mmaps[(key, shard)] = np.load(_shard_file(self.path, key, shard), mmap_mode="r")
+        return self._mmaps[(key, shard)]
+
+    def __getitem__(self, episode: int) -> Dict:
+        shard = self.episode_shard[episode]
+        flat = dict()
+        for k in self.keys:
+            start, end = self.episode_offsets[k][episode]
+            flat[k] = self._get_mmap(k, shard)[start:end]
+        return _unflatten(flat)
+
+    def __iter__(self):
+        for episode in range(len(self)):
+            yield self[episode]
+
+    def sample(self, batch_size: int, keys: Sequence[str] = None, next_keys: Sequence[str] = ()) -> Dict:
+        """
+        Sample a batch of transitions uniformly with replacement across all episodes and shards.
+
+        keys - flat keys to return (nested keys as "observations/state"), defaults to all keys
+        next_keys - keys to also return at the next timestep under "next_<key>", e.g. "observations" when the
+        observations include the terminal observation
+
+        Rows are read shard by shard in sorted order to keep disk access as sequential as possible
+        """
+        keys = list(self.keys.keys()) if keys is None else list(keys)
+        transition_ids = self.rng.integers(0, self.n_transitions, size=batch_size)
+        episodes = np.searchsorted(self.episode_start, transition_ids, side="right") - 1
+        t = transition_ids - self.episode_start[episodes]
+        shards = self.episode_shard[episodes]
+
+        requests = [(k, k, 0) for k in keys] + [(k, "next_" + k, 1) for k in next_keys]
+        flat = dict()
+        for k, out_key, shift in requests:
+            rows = self.episode_offsets[k][episodes, 0] + t + shift
+            out = np.empty((batch_size,) + tuple(self.keys[k]["shape"]), dtype=self.keys[k]["dtype"])
+            for shard in np.unique(shards):
+                batch_ids = np.where(shards == shard)[0]
+                order = np.argsort(rows[batch_ids])
+                batch_ids = batch_ids[order]
+                out[batch_ids] = self._get_mmap(k, shard)[rows[batch_ids]]
+            flat[out_key] = out
+        return _unflatten(flat)
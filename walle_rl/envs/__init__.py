@@ -0,0 +1,4 @@
+from .base import EnvState, JaxEnv
+from .cartpole import CartPole
+from .pendulum import Pendulum
+from .vec_env import SharedMemoryVecEnv, make_vec_env
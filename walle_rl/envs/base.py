@@ -0,0 +1,85 @@
+"""
+Functional environment definitions that are completely jittable. Loosely follows the gymnax API
+
+An environment here holds no state itself. reset and step are pure functions of a PRNGKey and an explicit state object,
+so they can be vmapped over many environments and scanned over time inside a single XLA program.
+"""
+
+from typing import Any, Dict, Tuple
+
+import jax
+import jax.numpy as jnp
+from chex import Array, PRNGKey
+from flax import struct
+from gym import spaces
+
+
+@struct.dataclass
+class EnvState:
+    """
+    Base environment state. Subclasses add their own physical state fields.
+    """
+
+    t: int
+
+
+class JaxEnv:
+    """
+    Base class for pure-JAX environments
+
+    Subclasses implement reset_env and step_env for a single environment. step automatically resets finished episodes
+    and reports the observation that ended the episode in info["terminal_observation"], just like SB3 vectorized envs.
+    """
+
+    max_episode_steps: int = 1000
+
+    def __hash__(self) -> int:
+        # environments are passed to jitted functions as static arguments
+        return id(self)
+
+    @property
+    def observation_space(self) -> spaces.Space:
+        raise NotImplementedError()
+
+    @property
+    def action_space(self) -> spaces.Space:
+        raise NotImplementedError()
+
+    def reset_env(self, key: PRNGKey) -> Tuple[EnvState, Array]:
+        raise NotImplementedError()
+
+    def step_env(self, key: PRNGKey, state: EnvState, action: Array) -> Tuple[EnvState, Array, Array, Array]:
+        """
+        returns the next state, observation, reward and whether the episode terminated (not including timeouts)
+        """
+        raise NotImplementedError()
+
+    def reset(self, key: PRNGKey) -> Tuple[EnvState, Array]:
+        return self.reset_env(key)
+
+    def step(self, key: PRNGKey, state: EnvState, action: Array) -> Tuple[EnvState, Array, Array, Array, Dict[str, Any]]:
+        """
+        step the environment once and automatically reset it if the episode terminated or timed out
+        """
+        key_step, key_reset = jax.random.split(key)
+        next_state, next_obs, reward, terminated = self.step_env(key_step, state, action)
+        truncated = jnp.logical_and(next_state.t >= self.max_episode_steps, ~terminated)
+        done = jnp.logical_or(terminated, truncated)
+        reset_state, reset_obs = self.reset_env(key_reset)
+        state = jax.tree_util.tree_map(lambda r, n: jnp.where(done, r, n), reset_state, next_state)
+        obs = jnp.where(done, reset_obs, next_obs)
+        info = dict(terminal_observation=next_obs, truncated=truncated)
+        return state, obs, reward, done, info
+
+    def vmap_reset(self, key: PRNGKey, n_envs: int) -> Tuple[EnvState, Array]:
+        """
+        reset n_envs copies of the environment
+        """
+        return jax.vmap(self.reset)(jax.random.split(key, n_envs))
+
+    def vmap_step(self, key: PRNGKey, state: EnvState, action: Array):
+        """
+        step a batch of environments, state and action should have a leading n_envs dimension
+        """
+        n_envs = action.shape[0]
+        return jax.vmap(self.step)(jax.random.split(key, n_envs), state, action)
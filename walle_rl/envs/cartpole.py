@@ -0,0 +1,86 @@
+"""
+CartPole-v1 written in pure JAX. Dynamics follow the classic control implementation in gym
+"""
+
+from typing import Tuple
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from chex import Array, PRNGKey
+from flax import struct
+from gym import spaces
+
+from walle_rl.envs.base import EnvState, JaxEnv
+
+
+@struct.dataclass
+class CartPoleState(EnvState):
+    x: float
+    x_dot: float
+    theta: float
+    theta_dot: float
+
+
+class CartPole(JaxEnv):
+    gravity = 9.8
+    masscart = 1.0
+    masspole = 0.1
+    total_mass = masspole + masscart
+    length = 0.5  # actually half the pole's length
+    polemass_length = masspole * length
+    force_mag = 10.0
+    tau = 0.02  # seconds between state updates
+    theta_threshold_radians = 12 * 2 * np.pi / 360
+    x_threshold = 2.4
+
+    def __init__(self, max_episode_steps: int = 500) -> None:
+        self.max_episode_steps = max_episode_steps
+
+    @property
+    def observation_space(self) -> spaces.Space:
+        high = np.array(
+            [self.x_threshold * 2, np.finfo(np.float32).max, self.theta_threshold_radians * 2, np.finfo(np.float32).max],
+            dtype=np.float32,
+        )
+        return spaces.Box(-high, high, dtype=np.float32)
+
+    @property
+    def action_space(self) -> spaces.Space:
+        return spaces.Discrete(2)
+
+    def _get_obs(self, state: CartPoleState) -> Array:
+        return jnp.array([state.x, state.x_dot, state.theta, state.theta_dot], dtype=jnp.float32)
+
+    def reset_env(self, key: PRNGKey) -> Tuple[CartPoleState, Array]:
+        init = jax.random.uniform(key, minval=-0.05, maxval=0.05, shape=(4,))
+        state = CartPoleState(t=0, x=init[0], x_dot=init[1], theta=init[2], theta_dot=init[3])
+        return state, self._get_obs(state)
+
+    def step_env(self, key: PRNGKey, state: CartPoleState, action: Array):
+        force = self.force_mag * (2 * action - 1)
+        costheta = jnp.cos(state.theta)
+        sintheta = jnp.sin(state.theta)
+
+        temp = (force + self.polemass_length * state.theta_dot**2 * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / (
+            self.length * (4.0 / 3.0 - self.masspole * costheta**2 / self.total_mass)
+        )
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+
+        # euler integration
+        x = state.x + self.tau * state.x_dot
+        x_dot = state.x_dot + self.tau * xacc
+        theta = state.theta + self.tau * state.theta_dot
+        theta_dot = state.theta_dot + self.tau * thetaacc
+
+        state = CartPoleState(t=state.t + 1, x=x, x_dot=x_dot, theta=theta, theta_dot=theta_dot)
+        terminated = (
+            (x < -self.x_threshold)
+            | (x > self.x_threshold)
+            | (theta < -self.theta_threshold_radians)
+            | (theta > self.theta_threshold_radians)
+        )
+        # gym gives a reward of 1 for every step including the one that terminates the episode
+        reward = jnp.float32(1.0)
+        return state, self._get_obs(state), reward, terminated
@@ -0,0 +1,66 @@
+"""
+Pendulum-v1 written in pure JAX. Dynamics follow the classic control implementation in gym
+"""
+
+from typing import Tuple
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from chex import Array, PRNGKey
+from flax import struct
+from gym import spaces
+
+from walle_rl.envs.base import EnvState, JaxEnv
+
+
+def angle_normalize(x):
+    return ((x + jnp.pi) % (2 * jnp.pi)) - jnp.pi
+
+
+@struct.dataclass
+class PendulumState(EnvState):
+    theta: float
+    theta_dot: float
+
+
+class Pendulum(JaxEnv):
+    max_speed = 8.0
+    max_torque = 2.0
+    dt = 0.05
+    g = 10.0
+    m = 1.0
+    l = 1.0
+
+    def __init__(self, max_episode_steps: int = 200) -> None:
+        self.max_episode_steps = max_episode_steps
+
+    @property
+    def observation_space(self) -> spaces.Space:
+        high = np.array([1.0, 1.0, self.max_speed], dtype=np.float32)
+        return spaces.Box(-high, high, dtype=np.float32)
+
+    @property
+    def action_space(self) -> spaces.Space:
+        return spaces.Box(low=-self.max_torque, high=self.max_torque, shape=(1,), dtype=np.float32)
+
+    def _get_obs(self, state: PendulumState) -> Array:
+        return jnp.array([jnp.cos(state.theta), jnp.sin(state.theta), state.theta_dot], dtype=jnp.float32)
+
+    def reset_env(self, key: PRNGKey) -> Tuple[PendulumState, Array]:
+        high = jnp.array([jnp.pi, 1.0])
+        init = jax.random.uniform(key, minval=-high, maxval=high, shape=(2,))
+        state = PendulumState(t=0, theta=init[0], theta_dot=init[1])
+        return state, self._get_obs(state)
+
+    def step_env(self, key: PRNGKey, state: PendulumState, action: Array):
+        u = jnp.clip(jnp.reshape(action, ()), -self.max_torque, self.max_torque)
+        costs = angle_normalize(state.theta) ** 2 + 0.1 * state.theta_dot**2 + 0.001 * (u**2)
+
+        theta_dot = state.theta_dot + (3 * self.g / (2 * self.l) * jnp.sin(state.theta) + 3.0 / (self.m * self.l**2) * u) * self.dt
+        theta_dot = jnp.clip(theta_dot, -self.max_speed, self.max_speed)
+        theta = state.theta + theta_dot * self.dt
+
+        state = PendulumState(t=state.t + 1, theta=theta, theta_dot=theta_dot)
+        # pendulum never terminates, episodes only end by timing out
+        return state, self._get_obs(state), -costs.astype(jnp.float32), jnp.array(False)
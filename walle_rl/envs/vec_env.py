@@ -0,0 +1,379 @@
+"""
+Vectorized environments that step gym environments in subprocesses.
+
+Observations, rewards, dones, truncations and actions are exchanged through preallocated multiprocessing.shared_memory arrays laid out
+like the PPOBuffer observation buffers ((n_envs,) + obs_shape per key for dict observations). Workers are signalled with
+barriers, so nothing is pickled per step except infos, and only when they are asked for.
+"""
+
+import functools
+import multiprocessing as mp
+import traceback
+from multiprocessing import shared_memory
+from threading import BrokenBarrierError
+from typing import Any, Callable, Dict, List, Optional
+
+import gym
+import numpy as np
+from gym import spaces
+
+from walle_rl.common.utils import get_obs_shape
+
+_RESET, _STEP, _STEP_INFOS, _CLOSE = 0, 1, 2, 3
+
+
+def _reset_env(env: gym.Env, seed: Optional[int] = None):
+    # supports both the old (obs) and new (obs, info) gym reset API
+    if seed is not None and not hasattr(env, "seed"):
+        res = env.reset(seed=seed)
+    else:
+        if seed is not None:
+            env.seed(seed)
+        res = env.reset()
+    if isinstance(res, tuple) and len(res) == 2 and isinstance(res[1], dict):
+        res = res[0]
+    return res
+
+
+def _step_env(env: gym.Env, action):
+    # supports both the old 4-tuple and new 5-tuple gym step API
+    res = env.step(action)
+    if len(res) == 5:
+        obs, reward, terminated, truncated, info = res
+        if truncated and not terminated:
+            info["TimeLimit.truncated"] = True
+        return obs, reward, terminated or truncated, info
+    return res
+
+
+def _obs_layout(observation_space: spaces.Space) -> Dict[Optional[str], tuple]:
+    """
+    returns key -> (shape, dtype) for each observation array. Non-dict observations use the key None
+    """
+    obs_shape = get_obs_shape(observation_space)
+    if isinstance(obs_shape, dict):
+        return {k: (obs_shape[k], observation_space[k].dtype) for k in obs_shape.keys()}
+    return {None: (obs_shape, observation_space.dtype)}
+
+
+def _create_shared_array(shape, dtype):
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _worker(
+    env_fns: List[Callable[[], gym.Env]],
+    env_offset: int,
+    shm_specs: Dict[str, Any],
+    command,
+    start_barrier,
+    done_barrier,
+    conn,
+    seed: Optional[int],
+):
+    arrays = {name: np.ndarray(shape, dtype=dtype, buffer=shm.buf) for name, (shm, shape, dtype) in shm_specs.items()}
+    obs_keys = [None if name == "obs" else name[len("obs/"):] for name in arrays.keys() if name.split("/")[0] == "obs"]
+
+    def write_obs(prefix, i, obs):
+        for k in obs_keys:
+            name, o = (prefix, obs) if k is None else (f"{prefix}/{k}", obs[k])
+            arrays[name][i] = np.asarray(o).reshape(arrays[name].shape[1:])
+
+    envs = []
+    try:
+        envs = [env_fn() for env_fn in env_fns]
+        # tell the parent the environments were created
+        conn.send(None)
+        first_reset = True
+        while True:
+            start_barrier.wait()
+            cmd = command.value
+            if cmd == _CLOSE:
+                break
+            infos = []
+            for j, env in enumerate(envs):
+                i = env_offset + j
+                if cmd == _RESET:
+                    env_seed = seed + i if (seed is not None and first_reset) else None
+                    write_obs("obs", i, _reset_env(env, env_seed))
+                else:
+                    action = arrays["actions"][i].copy()
+                    if action.shape == ():
+                        action = action.item()
+                    obs, reward, done, info = _step_env(env, action)
+                    arrays["rewards"][i] = reward
+                    arrays["dones"][i] = done
+                    arrays["truncated"][i] = done and info.get("TimeLimit.truncated", False)
+                    if done:
+                        write_obs("terminal_obs", i, obs)
+                        obs = _reset_env(env)
+                    write_obs("obs", i, obs)
+                    infos.append(info)
+            if cmd == _RESET:
+                first_reset = False
+            if cmd == _STEP_INFOS:
+                conn.send(infos)
+            done_barrier.wait()
+    except BrokenBarrierError:
+        pass
+    except Exception:
+        conn.send(traceback.format_exc())
+        start_barrier.abort()
+        done_barrier.abort()
+    finally:
+        for env in envs:
+            env.close()
+        conn.close()
+
+
+class SharedMemoryVecEnv:
+    """
+    Subprocess vectorized environment with a SB3 VecEnv compatible reset / step API.
+
+    Each worker process steps a contiguous slice of the environments and writes observations, rewards and dones
+    directly into shared memory. Finished episodes are reset automatically and the observation that ended the episode
+    is returned in infos[i]["terminal_observation"], as in SB3. Episodes ended by a time limit also get
+    infos[i]["TimeLimit.truncated"] = True, with or without return_infos.
+
+    Parameters
+    ----------
+    env_fns - list of functions that create each environment. With the "spawn" and "forkserver" start methods they must
+    be picklable
+
+    n_workers - number of worker processes, defaults to one per environment
+
+    seed - if given, environment i is seeded with seed + i on the first reset
+
+    return_infos - if True, the info dicts of every step are pickled back from the workers. Otherwise step returns infos
+    that only contain terminal_observation and TimeLimit.truncated for environments that finished, which is all Rollout
+    and PPO need
+
+    copy - if True, returned observations are copies. Otherwise they are views into shared memory that are overwritten by
+    the next step or reset
+
+    start_method - multiprocessing start method of the workers. Defaults to "forkserver" where available and "spawn"
+    otherwise, as forking a process that already runs JAX's threads can deadlock. Like with SB3's SubprocVecEnv, scripts
+    then have to create the environments under if __name__ == "__main__"
+    """
+
+    def __init__(
+        self,
+        env_fns: List[Callable[[], gym.Env]],
+        n_workers: int = None,
+        seed: Optional[int] = None,
+        return_infos: bool = False,
+        copy: bool = True,
+        start_method: str = None,
+    ) -> None:
+        self.num_envs = len(env_fns)
+        self.n_workers = self.num_envs if n_workers is None else min(n_workers, self.num_envs)
+        self.return_infos = return_infos
+        self.copy = copy
+        self.closed = False
+        self._pending_cmd = None
+
+        probe_env = env_fns[0]()
+        self.observation_space = probe_env.observation_space
+        self.action_space = probe_env.action_space
+        probe_env.close()
+
+        self.is_dict = isinstance(self.observation_space, spaces.Dict)
+        self.obs_layout = _obs_layout(self.observation_space)
+
+        # allocate shared memory
+        specs = dict()
+        for k, (shape, dtype) in self.obs_layout.items():
+            suffix = "" if k is None else f"/{k}"
+            specs["obs" + suffix] = ((self.num_envs,) + shape, dtype)
+            specs["terminal_obs" + suffix] = ((self.num_envs,) + shape, dtype)
+        specs["actions"] = ((self.num_envs,) + self.action_space.shape, self.action_space.dtype)
+        specs["rewards"] = ((self.num_envs,), np.float32)
+        specs["dones"] = ((self.num_envs,), np.bool_)
+        specs["truncated"] = ((self.num_envs,), np.bool_)
+        self._shms = dict()
+        self._arrays = dict()
+        for name, (shape, dtype) in specs.items():
+            self._shms[name], self._arrays[name] = _create_shared_array(shape, dtype)
+        shm_specs = {name: (self._shms[name], shape, np.dtype(dtype)) for name, (shape, dtype) in specs.items()}
+
+        if start_method is None:
+            start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+        ctx = mp.get_context(start_method)
+        self._command = ctx.Value("i", _RESET, lock=False)
+        self._start_barrier = ctx.Barrier(self.n_workers + 1)
+        self._done_barrier = ctx.Barrier(self.n_workers + 1)
+        self._conns = []
+        self._processes = []
+        try:
+            self._start_workers(ctx, env_fns, shm_specs, seed)
+        except BaseException:
+            # e.g. an unguarded main module re-imported by a worker, don't leak the shared memory or the workers
+            self._start_barrier.abort()
+            self.close()
+            raise
+
+    def _start_workers(self, ctx, env_fns: List[Callable[[], gym.Env]], shm_specs: Dict[str, Any], seed: Optional[int]):
+        """
+        start the worker processes and wait until all of them created their environments
+        """
+        splits = np.array_split(np.arange(self.num_envs), self.n_workers)
+        for env_ids in splits:
+            parent_conn, child_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(
+                target=_worker,
+                args=(
+                    [env_fns[i] for i in env_ids],
+                    int(env_ids[0]),
+                    shm_specs,
+                    self._command,
+                    self._start_barrier,
+                    self._done_barrier,
+                    child_conn,
+                    seed,
+                ),
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._processes.append(process)
+        for conn in self._conns:
+            try:
+                res = conn.recv()
+            except EOFError:
+                res = (
+                    "the worker exited before creating its environments. With the spawn and forkserver start methods, "
+                    'create the environments under if __name__ == "__main__"'
+                )
+            if isinstance(res, str):
+                raise RuntimeError(f"Environment worker failed:\n{res}")
+
+    def _run_async(self, cmd: int):
+        """
+        signal the workers to run cmd without waiting for them to finish
+        """
+        self._command.value = cmd
+        self._pending_cmd = cmd
+        try:
+            self._start_barrier.wait()
+        except BrokenBarrierError:
+            raise RuntimeError("Environment worker failed:\n" + "\n".join(self._collect_errors()))
+
+    def _wait(self):
+        """
+        wait for the workers to finish the pending command, returns the pickled infos if they were asked for
+        """
+        cmd, self._pending_cmd = self._pending_cmd, None
+        try:
+            infos = None
+            if cmd == _STEP_INFOS:
+                infos = []
+                for conn in self._conns:
+                    res = conn.recv()
+                    if isinstance(res, str):
+                        raise RuntimeError(f"Environment worker failed:\n{res}")
+                    infos += res
+            self._done_barrier.wait()
+        except (BrokenBarrierError, EOFError):
+            raise RuntimeError("Environment worker failed:\n" + "\n".join(self._collect_errors()))
+        return infos
+
+    def _collect_errors(self) -> List[str]:
+        errors = []
+        for conn in self._conns:
+            try:
+                while conn.poll():
+                    res = conn.recv()
+                    if isinstance(res, str):
+                        errors.append(res)
+            except (EOFError, OSError):
+                pass
+        return errors
+
+    def _get_obs(self, prefix="obs"):
+        def get(name):
+            data = self._arrays[name]
+            return data.copy() if self.copy else data
+
+        if self.is_dict:
+            return {k: get(f"{prefix}/{k}") for k in self.obs_layout.keys()}
+        return get(prefix)
+
+    def reset(self):
+        self._run_async(_RESET)
+        self._wait()
+        return self._get_obs()
+
+    def step_async(self, actions):
+        """
+        start stepping all environments with the given actions and return immediately. Call step_wait to get the results
+        """
+        self._arrays["actions"][:] = np.asarray(actions).reshape(self._arrays["actions"].shape)
+        self._run_async(_STEP_INFOS if self.return_infos else _STEP)
+
+    def step_wait(self):
+        infos = self._wait()
+        dones = self._arrays["dones"].copy()
+        rewards = self._arrays["rewards"].copy()
+        truncated = self._arrays["truncated"]
+        if infos is None:
+            infos = [dict() for _ in range(self.num_envs)]
+        for idx in np.where(dones)[0]:
+            if self.is_dict:
+                infos[idx]["terminal_observation"] = {
+                    k: self._arrays[f"terminal_obs/{k}"][idx].copy() for k in self.obs_layout.keys()
+                }
+            else:
+                infos[idx]["terminal_observation"] = self._arrays["terminal_obs"][idx].copy()
+            if truncated[idx]:
+                infos[idx]["TimeLimit.truncated"] = True
+        return self._get_obs(), rewards, dones, infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self._start_barrier.broken:
+            if self._pending_cmd is not None:
+                self._wait()
+            self._run_async(_CLOSE)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for conn in self._conns:
+            conn.close()
+        self._arrays = dict()
+        for shm in self._shms.values():
+            shm.close()
+            shm.unlink()
+
+
+def make_vec_env(
+    env_id: str,
+    n_envs: int = 1,
+    seed: Optional[int] = None,
+    n_workers: int = None,
+    return_infos: bool = False,
+    env_kwargs: Dict[str, Any] = None,
+    start_method: str = None,
+) -> SharedMemoryVecEnv:
+    """
+    Create a SharedMemoryVecEnv of n_envs copies of a registered gym environment. Drop in replacement for the SB3
+    make_vec_env
+
+    start_method - multiprocessing start method of the workers, e.g. "fork", "spawn" or "forkserver". Defaults to
+    "forkserver" where available and "spawn" otherwise, see SharedMemoryVecEnv
+    """
+    env_kwargs = {} if env_kwargs is None else env_kwargs
+    # a partial of a module level function stays picklable for the spawn and forkserver start methods
+    make_env = functools.partial(gym.make, env_id, **env_kwargs)
+    return SharedMemoryVecEnv(
+        [make_env] * n_envs, n_workers=n_workers, seed=seed, return_infos=return_infos, start_method=start_method
+    )
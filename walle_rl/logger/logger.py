@@ -159,6 +159,26 @@ class Logger:
             else:
                 self.data[tag][k] = v
 
+    def extend(self, tag="default", **kwargs):
+        """
+        Stores a batch of scalar values under each tag and key in one call, equivalent to calling store with append=True
+        once for every value
+
+        Parameters
+        ----------
+        kwargs :
+            each value is an array or list of scalars, e.g. the returns of all episodes that finished this step. Empty
+            values are skipped, so no key is created that would have no stats to log
+        """
+        for k, v in kwargs.items():
+            vals = list(np.asarray(v).reshape(-1))
+            if len(vals) == 0:
+                continue
+            if k in self.data[tag]:
+                self.data[tag][k].extend(vals)
+            else:
+                self.data[tag][k] = vals
+
     def get_data(self, tag=None):
         if tag is None:
             data_dict = {}